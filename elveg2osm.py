@@ -1,10 +1,24 @@
 #! /usr/bin/env python2
 import sys
 import os
+import time
+import json
+import argparse
+import collections
+import resource
+from array import array
 import osmapis
 import csv
 import numpy as np
 import geographiclib.geodesic as gg
+import elveg_osmio
+import elveg_sosi
+import elveg_restrictions
+import elveg_diagnostics
+import elveg_archive
+import elveg_tiles
+import elveg_tagstore
+import elveg_diff
 
 # Output have the following temporary features:
 # - The split nodes have tags newnode=yes
@@ -14,50 +28,158 @@ import geographiclib.geodesic as gg
 # Add useful (for our purpose) methods to the osmapis.OSM class
 class ElvegOSM(osmapis.OSM):
 
-    def __init__(self, items=()):
+    def __init__(self, items=(), ids=None, diagnostics=None):
         # First call the parent's __init__
         super(ElvegOSM, self).__init__(items)
 
-        # Generate dict with TRANSID as key and is as value
-        self.wayid_dict = {}
-        for wayid,way in self.ways.iteritems():
-            transid = way.tags['TRANSID']
-            self.wayid_dict[transid] = wayid
-
-    def way_nodes_from_transid(self, transid):
-        wayid = self.wayid_dict[transid]
-        way = self.ways[wayid]
-        node_ids = way.nds
-        nodes = [osmobj.nodes[nid] for nid in node_ids]
-        return nodes
-
-    def distances_from_transid(self, transid):
-        global g
-        nodes = self.way_nodes_from_transid(transid)
-        node_distances = []
-        distance_so_far = 0.
-        prev_lon = nodes[0].lon
-        prev_lat = nodes[0].lat
-        
-        for i,nd in enumerate(nodes):
-            #az1,az2,d_from_previous = g.inv(prev_lon, prev_lat, nd.lon, nd.lat)
-            ggresults = gg.Geodesic.WGS84.Inverse(prev_lat, prev_lon, nd.lat, nd.lon)
-            d_from_previous = ggresults['s12']
-            if i != 0 and d_from_previous < 0.5:
-                # Report if very short distance
-                warn(u"Short distance ({2}) for transid {0} to node No. {1}".format(transid, i,d_from_previous))
-            distance_so_far += d_from_previous
-            node_distances.append(distance_so_far)
-            # Prepare previous coordinates for next round
-            prev_lon = nd.lon
-            prev_lat = nd.lat
-
-        return node_distances
+        # Warnings go to the Diagnostics, by default to standard error
+        if diagnostics is None:
+            diagnostics = elveg_diagnostics.Diagnostics()
+        self.diagnostics = diagnostics
+
+        # Ids of the loaded and the new elements. The items keep their
+        # ids, but the loaders below map the ids of the input with
+        # the IdAllocator.
+        if ids is None:
+            ids = IdAllocator()
+        self.ids = ids
+
+        # One copy of each tag key and value of the loaded Elveg tags
+        self.strings = elveg_tagstore.StringTable(unique_keys=('TRANSID',))
+
+        # Keep the nodes in a compact NodeStore instead of a dict
+        nodes = self.nodes
+        self.nodes = NodeStore()
+        for node in nodes.itervalues():
+            self.nodes[node.id] = node
+            ids.reserve_node_id(node.id)
+        # Count the references from ways to each node. Ways should be
+        # added and removed with add_way() and remove_way(), and their
+        # nodes changed with set_way_nodes(), to keep the counts right.
+        for way in self.ways.itervalues():
+            self.nodes.add_refs(way.nds)
+            ids.reserve_way_id(way.id)
+
+    @classmethod
+    def iterload(cls, source, ids=None, diagnostics=None):
+        '''Load an OSM file incrementally without keeping the XML tree.
+
+        Unlike load(), the elements are added to the node and way dicts
+        as they are parsed. The tags of the file (i.e. the Elveg tags
+        from sosi2osm) are stored as elveg_tags, with interned keys and
+        values, and the ids are mapped with the IdAllocator ids.
+
+        '''
+        osmobj = cls(ids=ids, diagnostics=diagnostics)
+        ids = osmobj.ids
+        for element_type, attribs, tags, nds in elveg_osmio.iterparse_osm(source):
+            if element_type == 'node':
+                # Add directly to the NodeStore without creating a node object
+                osmobj.nodes.add(ids.node_id(attribs['id']), attribs['lat'], attribs['lon'], {},
+                                 osmobj.strings.intern_tags(tags))
+            elif element_type == 'way':
+                attribs['id'] = ids.way_id(attribs['id'])
+                osmobj._add_way(attribs, [ids.node_id(nid) for nid in nds], tags)
+            else:
+                osmobj.diagnostics.warn('ignored-element', u"Ignoring {0} {1}".format(element_type, attribs['id']),
+                                        element_type=element_type, id=attribs['id'])
+        return osmobj
+
+    @classmethod
+    def load_sosi(cls, source, ids=None, diagnostics=None):
+        '''Load an Elveg SOSI file directly, without sosi2osm.
+
+        As with sosi2osm, curves get the same node where they share a
+        point, while each point object (e.g. a barrier) gets a node of
+        its own. The elements are numbered -1, -2, ... in the order of
+        the file, mapped with the IdAllocator ids. The SOSI attributes
+        are stored as elveg_tags.
+
+        '''
+        osmobj = cls(ids=ids, diagnostics=diagnostics)
+        ids = osmobj.ids
+        node_id = 0
+        way_id = 0
+        curve_nodes = dict()
+        for obj in elveg_sosi.SosiReader(source):
+            coords = zip(obj.lats.tolist(), obj.lons.tolist())
+            if obj.group == u'KURVE':
+                nds = []
+                for lat, lon in coords:
+                    nid = curve_nodes.get((lat, lon))
+                    if nid is None:
+                        node_id -= 1
+                        nid = curve_nodes[(lat, lon)] = ids.node_id(node_id)
+                        osmobj.nodes.add(nid, lat, lon)
+                    nds.append(nid)
+                way_id -= 1
+                osmobj._add_way({'id': ids.way_id(way_id)}, nds, obj.tags)
+            elif obj.group == u'PUNKT' and len(coords) > 0:
+                node_id -= 1
+                lat, lon = coords[0]
+                osmobj.nodes.add(ids.node_id(node_id), lat, lon, {}, osmobj.strings.intern_tags(obj.tags))
+            else:
+                osmobj.diagnostics.warn('ignored-element', u"Ignoring SOSI object {0} {1}".format(obj.group, obj.serial),
+                                        element_type=obj.group, id=obj.serial)
+        return osmobj
+
+    def _add_way(self, attribs, nds, elveg_tags):
+        way = osmapis.wrappers['way'](attribs, {}, nds)
+        way.elveg_tags = self.strings.intern_tags(elveg_tags)
+        self.add_way(way)
+
+    def add_way(self, way):
+        '''Add a way, and count its references to its nodes'''
+        self.ways[way.id] = way
+        self.nodes.add_refs(way.nds)
+
+    def set_way_nodes(self, way, nds):
+        '''Replace the nodes of a way, and update the node references'''
+        self.nodes.add_refs(nds)
+        self.nodes.remove_refs(way.nds)
+        way.nds = nds
+
+    def remove_way(self, way):
+        '''Remove a way, and its references to its nodes'''
+        self.discard(way)
+        self.nodes.remove_refs(way.nds)
+
+    def drop_elveg_tags(self, ways=True, nodes=True):
+        '''Free the Elveg tags of the ways and/or nodes, when the
+        conversion no longer needs them'''
+        if ways:
+            for way in self.ways.itervalues():
+                if hasattr(way, 'elveg_tags'):
+                    del way.elveg_tags
+        if nodes:
+            self.nodes.elveg_tags = dict()
+
+    def stream_save(self, filename):
+        '''Save nodes and ways one at a time, instead of building the whole document.
+
+        The format is given by the file name, see elveg_osmio.open_writer().
+
+        '''
+        writer = elveg_osmio.open_writer(filename)
+        for nid in sorted(self.nodes, reverse=True):
+            node = self.nodes[nid]
+            writer.write_node(nid, node.lat, node.lon, node.tags)
+        for wid in sorted(self.ways, reverse=True):
+            way = self.ways[wid]
+            writer.write_way(wid, way.nds, way.tags)
+        writer.close()
+
 
 class ElvegNode(osmapis.Node):
 
     def __init__(self, attribs={}, tags={}):
-        osmapis.Node.__init__(self, attribs, tags)
+        if isinstance(tags, elveg_tagstore.CowTags):
+            # Keep sharing the base tags instead of a copy in a dict,
+            # which the base class would make
+            osmapis.Node.__init__(self, attribs, {})
+            self.tags = tags.copy()
+        else:
+            osmapis.Node.__init__(self, attribs, tags)
         # Make sure the class counter is as low as the lowest existing ID
         # This should probably have been done in osmapis.Node
         if self.id is not None:
@@ -66,629 +188,1479 @@ class ElvegNode(osmapis.Node):
 class ElvegWay(osmapis.Way):
 
     def __init__(self, attribs={}, tags={}, nds=()):
-        osmapis.Way.__init__(self, attribs, tags, nds)
+        if isinstance(tags, elveg_tagstore.CowTags):
+            # Keep sharing the base tags (e.g. with the other segments
+            # of a split way) instead of a copy in a dict, which the
+            # base class would make
+            osmapis.Way.__init__(self, attribs, {}, nds)
+            self.tags = tags.copy()
+        else:
+            osmapis.Way.__init__(self, attribs, tags, nds)
         # Make sure the class counter is as low as the lowest existing ID
         # This should probably have been done in osmapis.Way
         if self.id is not None:
             self.__class__._counter = min(self.__class__._counter, self.id)
 
+class IdAllocator(object):
+    '''Ids of the nodes and ways of a municipality.
+
+    Without a block, the ids of the input are kept, and new nodes and
+    ways get ids below the lowest id of the input, as with the
+    counters of ElvegNode and ElvegWay.
+
+    With a block number (e.g. the kommune number), all ids are in the
+    range [-(block + 1) * block_size, -block * block_size), so that the
+    outputs of different municipalities can be combined without
+    renumbering. The negative ids of the input are offset into the
+    upper half of the range, and new nodes and ways get ids from the
+    lower half, counting down.
+
+    '''
+
+    def __init__(self, block=None, block_size=10**7):
+        self.block = block
+        self.block_size = block_size
+        if block is None:
+            self.offset = 0
+            self.limit = None
+        else:
+            self.offset = -block * block_size
+            self.limit = self.offset - block_size
+        self.next_node_id = self.next_way_id = self.offset - (block_size // 2 if block is not None else 0)
+
+    def _input_id(self, element_id):
+        if self.block is None:
+            return element_id
+        if not -(self.block_size // 2) < element_id < 0:
+            raise ValueError("Input id {0} does not fit in id block {1}".format(element_id, self.block))
+        return self.offset + element_id
+
+    def node_id(self, input_id):
+        '''Return the id of the node with input_id in the input'''
+        element_id = self._input_id(input_id)
+        self.reserve_node_id(element_id)
+        return element_id
+
+    def way_id(self, input_id):
+        '''Return the id of the way with input_id in the input'''
+        element_id = self._input_id(input_id)
+        self.reserve_way_id(element_id)
+        return element_id
+
+    def reserve_node_id(self, element_id):
+        '''Make sure that new nodes get ids below element_id'''
+        if self.block is None:
+            self.next_node_id = min(self.next_node_id, element_id)
+
+    def reserve_way_id(self, element_id):
+        if self.block is None:
+            self.next_way_id = min(self.next_way_id, element_id)
+
+    def _check(self, element_id):
+        if self.limit is not None and element_id < self.limit:
+            raise ValueError("Id block {0} is full".format(self.block))
+        return element_id
+
+    def new_node_id(self):
+        self.next_node_id -= 1
+        return self._check(self.next_node_id)
+
+    def new_way_id(self):
+        self.next_way_id -= 1
+        return self._check(self.next_way_id)
+
+
+class _PendingTags(dict):
+    '''Empty tag dict that is added to a NodeStore when the first tag is set'''
+
+    def __init__(self, tag_dicts, slot):
+        dict.__init__(self)
+        self._tag_dicts = tag_dicts
+        self._slot = slot
+
+    def _register(self):
+        self._tag_dicts[self._slot] = self
+
+    def __setitem__(self, key, value):
+        self._register()
+        dict.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        self._register()
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._register()
+        return dict.setdefault(self, key, default)
+
+class StoredNode(object):
+    '''Lightweight view of a node in a NodeStore.
+
+    Has the same id, lat, lon, tags and elveg_tags attributes as an
+    ElvegNode, but the data is kept in the NodeStore.
+
+    '''
+    __slots__ = ('_store', '_slot')
+
+    def __init__(self, store, slot):
+        self._store = store
+        self._slot = slot
+
+    @property
+    def id(self):
+        return self._store.ids[self._slot]
+
+    def _get_lat(self):
+        return self._store.lats[self._slot]
+    def _set_lat(self, lat):
+        self._store.lats[self._slot] = lat
+    lat = property(_get_lat, _set_lat)
+
+    def _get_lon(self):
+        return self._store.lons[self._slot]
+    def _set_lon(self, lon):
+        self._store.lons[self._slot] = lon
+    lon = property(_get_lon, _set_lon)
+
+    def _get_tags(self):
+        return self._store._get_tags(self._store.tags, self._slot)
+    def _set_tags(self, tags):
+        self._store._set_tags(self._store.tags, self._slot, tags)
+    tags = property(_get_tags, _set_tags)
+
+    def _get_elveg_tags(self):
+        return self._store._get_tags(self._store.elveg_tags, self._slot)
+    def _set_elveg_tags(self, tags):
+        self._store._set_tags(self._store.elveg_tags, self._slot, tags)
+    elveg_tags = property(_get_elveg_tags, _set_elveg_tags)
+
+class NodeStore(object):
+    '''Compact dict-like storage of nodes, keyed on node id.
+
+    Ids and coordinates are kept in typed arrays, and tags only for
+    the nodes that have them, since most nodes are untagged way nodes.
+    The number of references from ways to each node is kept as well,
+    so that way nodes and unused nodes are found without scanning
+    the ways.
+    Looking up a node returns a StoredNode view, and assigning a node
+    object (e.g. an ElvegNode) copies its data into the store.
+
+    '''
+
+    def __init__(self):
+        self.slots = dict()
+        self.ids = array('l')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.refcounts = array('l')
+        # Sparse tag dicts, keyed on slot
+        self.tags = dict()
+        self.elveg_tags = dict()
+
+    def add(self, nid, lat, lon, tags={}, elveg_tags={}):
+        if self.slots.has_key(nid):
+            slot = self.slots[nid]
+            self.lats[slot] = lat
+            self.lons[slot] = lon
+        else:
+            slot = len(self.ids)
+            self.slots[nid] = slot
+            self.ids.append(nid)
+            self.lats.append(lat)
+            self.lons.append(lon)
+            self.refcounts.append(0)
+        self._set_tags(self.tags, slot, tags)
+        self._set_tags(self.elveg_tags, slot, elveg_tags)
+
+    def _get_tags(self, tag_dicts, slot):
+        tags = tag_dicts.get(slot)
+        if tags is None:
+            return _PendingTags(tag_dicts, slot)
+        return tags
+
+    def _set_tags(self, tag_dicts, slot, tags):
+        if len(tags) > 0:
+            tag_dicts[slot] = tags
+        else:
+            tag_dicts.pop(slot, None)
+
+    def coords(self, nids):
+        '''Return arrays of latitudes and longitudes for the given node ids'''
+        slots = np.array([self.slots[nid] for nid in nids], dtype=int)
+        lats = np.frombuffer(self.lats, dtype=float)[slots]
+        lons = np.frombuffer(self.lons, dtype=float)[slots]
+        return lats, lons
+
+    def itercoords(self):
+        '''Iterate over (node id, lat, lon, number of way references)
+        without creating node views'''
+        for nid,slot in self.slots.iteritems():
+            yield nid, self.lats[slot], self.lons[slot], self.refcounts[slot]
+
+    def add_refs(self, nids, count=1):
+        '''Add count to the number of way references of each node'''
+        slots = self.slots
+        refcounts = self.refcounts
+        for nid in nids:
+            refcounts[slots[nid]] += count
+
+    def remove_refs(self, nids):
+        self.add_refs(nids, -1)
+
+    def refcount(self, nid):
+        '''Return the number of references from ways to the node'''
+        return self.refcounts[self.slots[nid]]
+
+    def compact(self, keep):
+        '''Remove nodes, and the space left by deleted nodes, in one pass.
+
+        keep(refcount, tags) is called for each node with its number of
+        way references and its tags, and the node is removed unless it
+        returns True.
+
+        '''
+        slots = dict()
+        ids = array('l')
+        lats = array('d')
+        lons = array('d')
+        refcounts = array('l')
+        tags = dict()
+        elveg_tags = dict()
+        for slot in sorted(self.slots.itervalues()):
+            node_tags = self.tags.get(slot, {})
+            if not keep(self.refcounts[slot], node_tags):
+                continue
+            new_slot = len(ids)
+            slots[self.ids[slot]] = new_slot
+            ids.append(self.ids[slot])
+            lats.append(self.lats[slot])
+            lons.append(self.lons[slot])
+            refcounts.append(self.refcounts[slot])
+            if len(node_tags) > 0:
+                tags[new_slot] = node_tags
+            if self.elveg_tags.has_key(slot):
+                elveg_tags[new_slot] = self.elveg_tags[slot]
+        self.slots = slots
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.refcounts = refcounts
+        self.tags = tags
+        self.elveg_tags = elveg_tags
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, nid):
+        return nid in self.slots
+
+    def has_key(self, nid):
+        return self.slots.has_key(nid)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def iterkeys(self):
+        return self.slots.iterkeys()
+
+    def keys(self):
+        return self.slots.keys()
+
+    def __getitem__(self, nid):
+        return StoredNode(self, self.slots[nid])
+
+    def get(self, nid, default=None):
+        if self.slots.has_key(nid):
+            return self[nid]
+        return default
+
+    def itervalues(self):
+        for slot in self.slots.itervalues():
+            yield StoredNode(self, slot)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for nid,slot in self.slots.iteritems():
+            yield nid, StoredNode(self, slot)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, nid, node):
+        self.add(nid, node.lat, node.lon, node.tags, getattr(node, 'elveg_tags', {}))
+
+    def __delitem__(self, nid):
+        slot = self.slots.pop(nid)
+        # The coordinates are left in the arrays until compact()
+        self.tags.pop(slot, None)
+        self.elveg_tags.pop(slot, None)
+
+    def pop(self, nid, *default):
+        '''Remove a node and return it as an ElvegNode'''
+        if not self.slots.has_key(nid) and len(default) > 0:
+            return default[0]
+        stored = self[nid]
+        node = ElvegNode(attribs={"id": nid, "lat": stored.lat, "lon": stored.lon},
+                         tags=stored.tags)
+        node.elveg_tags = stored.elveg_tags
+        del self[nid]
+        return node
+
 
 # Override default classes in osmapis.py
 osmapis.wrappers["osm"]  = ElvegOSM
 osmapis.wrappers["node"] = ElvegNode
 osmapis.wrappers["way"]  = ElvegWay
 
-def warn(warning):
-    warning = warning.encode('utf-8')
-    sys.stderr.write(warning + '\n')
-
-def waynode_from_coord(coord):
-    # This assumes that there is only one node for a given
-    # coordinates that is part of a way.
-    global way_node_ids
-    global node_lookup
-    way_nodes = [nid for nid in node_lookup[coord] if nid in way_node_ids]
-    if len(way_nodes) > 1:
-        sys.stderr.write('More than one way nodes at coordinate:\n')
-        sys.stderr.write(str(coord) + '\n')
-    elif len(way_nodes) == 0:
-        #sys.stderr.write('No way nodes at coordinate:\n')
-        #sys.stderr.write(str(coord) + '\n')
-        return None
-    return way_nodes[0]
-
-def merge_nodes(to_node_id, from_node_id):
-    #print u"Merging into node {0} from node {1}".format(to_node_id, from_node_id)
-    global osmobj
-    for tag in osmobj.nodes[from_node_id].tags.iterkeys():
-        if osmobj.nodes[to_node_id].tags.has_key(tag):
-            # Potential conflict, but only if the value is different
-            if osmobj.nodes[to_node_id].tags[tag] != osmobj.nodes[from_node_id].tags[tag]:
-                # A conflict for real
-                errmsg = u"Conflict in merging nodes {0} and {1} for tag {2}\n".format(to_node_id, from_node_id, tag)
-                # Hairy - if this Exception is caught, some tags will have been copied
-                raise KeyError(errmsg.encode('utf-8'))
-        # No confict, so copy tags
-        osmobj.nodes[to_node_id].tags[tag] = osmobj.nodes[from_node_id].tags[tag]
-    # Delete the from_node
-    osmobj.nodes.pop(from_node_id)
+# Segments longer than this (in meters) are recomputed with geographiclib,
+# as the approximation in segment_lengths() is made for short segments
+exact_distance_limit = 1000.
 
+def segment_lengths(lats, lons, skip=None):
+    '''Compute geodesic lengths of the segments between consecutive coordinates.
 
+    Uses the radii of curvature of the WGS84 ellipsoid at the mean
+    latitude of each segment, which is accurate to well below a
+    millimeter for segments shorter than exact_distance_limit. The
+    segments with the indices in skip (e.g. between the coordinates of
+    different ways) are not needed, and are not recomputed.
 
-def create_osmtags(elveg_tags):
-    '''Create tags based on standard tags in ????Elveg_default.osm'''
+    '''
+    a = gg.Geodesic.WGS84.a
+    f = gg.Geodesic.WGS84.f
+    e2 = f * (2 - f)
+    phi = np.radians(lats)
+    lam = np.radians(lons)
+    phi_mean = 0.5 * (phi[1:] + phi[:-1])
+    w2 = 1 - e2 * np.sin(phi_mean)**2
+    meridional_radius = a * (1 - e2) / w2**1.5
+    normal_radius = a / np.sqrt(w2)
+    lengths = np.hypot(meridional_radius * np.diff(phi),
+                       normal_radius * np.cos(phi_mean) * np.diff(lam))
+    exact = lengths > exact_distance_limit
+    if skip is not None:
+        exact[skip] = False
+    for i in np.nonzero(exact)[0]:
+        ggresults = gg.Geodesic.WGS84.Inverse(lats[i], lons[i], lats[i + 1], lons[i + 1])
+        lengths[i] = ggresults['s12']
+    return lengths
+
+def interpolate(lats1, lons1, lats2, lons2, fractions):
+    '''Return the coordinates at fractions of the way between arrays of
+    coordinates.
+
+    Interpolates along great circles, which are within a millimeter
+    of the geodesics for segments shorter than exact_distance_limit.
 
-    category2highwayclass = {'E': 'trunk',     # Europaveg
-                             'R': 'trunk',     # Riksveg
-                             'F': 'secondary', # Fylkesveg, could also be primary
-                             'K': 'road',      # Kommunal veg
-                             'P': 'road',      # Privat veg
-                             'S': 'track'}     # Skogsbilveg, possibly more info in the LBVKLASSE tag
+    '''
+    phi1 = np.radians(lats1)
+    phi2 = np.radians(lats2)
+    lam1 = np.radians(lons1)
+    lam2 = np.radians(lons2)
+    a = np.array([np.cos(phi1) * np.cos(lam1), np.cos(phi1) * np.sin(lam1), np.sin(phi1)])
+    b = np.array([np.cos(phi2) * np.cos(lam2), np.cos(phi2) * np.sin(lam2), np.sin(phi2)])
+    # Angle between the points
+    omega = np.arctan2(np.sqrt((np.cross(a, b, axis=0)**2).sum(axis=0)), (a * b).sum(axis=0))
+    sin_omega = np.sin(omega)
+    v = (np.sin((1 - fractions) * omega) / sin_omega * a +
+         np.sin(fractions * omega) / sin_omega * b)
+    return (np.degrees(np.arctan2(v[2], np.hypot(v[0], v[1]))),
+            np.degrees(np.arctan2(v[1], v[0])))
+
+def node_distances(lengths, transid, diagnostics):
+    '''Return array of distances from the start of a way to each node,
+    from the lengths of its segments'''
+    for i in np.nonzero(lengths < 0.5)[0]:
+        # Report if very short distance
+        diagnostics.warn('short-distance',
+                         u"Short distance ({2}) for transid {0} to node No. {1}".format(transid, i + 1, lengths[i]),
+                         transid=transid, node=int(i + 1), distance=float(lengths[i]))
+    distances = np.zeros(len(lengths) + 1)
+    np.cumsum(lengths, out=distances[1:])
+    return distances
+
+# Maximum distance (in meters) between a barrier and a way node for the
+# barrier to be merged into the way node
+barrier_merge_tolerance = 0.05
+
+class CoordinateIndex(object):
+    '''Index of the nodes of an ElvegOSM object by coordinate.
+
+    Maps each (lat, lon) coordinate to the way node at that coordinate
+    and to the free-standing nodes, i.e. nodes that are not part of
+    any way according to the node references of the NodeStore. Way
+    nodes are also hashed into grid buckets, so that way nodes within
+    a tolerance (in meters) of a coordinate can be found.
+
+    The index should be built after all ways have been split.
+    Warnings go to the diagnostics of osmobj.
 
-    roadOBJTYPEs = set([u'VegSenterlinje', 
-                        u'Svingekonnekteringslenke',
-                        u'Kj\xf8refelt',
-                        u'Kj\xf8rebane'])
+    '''
+    # Approximate length in meters of one degree of latitude, and of
+    # one degree of longitude at the equator
+    meters_per_degree_lat = 111132.
+    meters_per_degree_lon = 111320.
+
+    def __init__(self, osmobj, tolerance=0.):
+        self.tolerance = tolerance
+        self.diagnostics = osmobj.diagnostics
+        # Grid cell size in degrees (in both directions)
+        if tolerance > 0:
+            self.cell_size = tolerance / self.meters_per_degree_lat
+        else:
+            self.cell_size = None
+
+        self.way_node_count = 0
+        self.way_nodes = dict()
+        self.free_nodes = dict()
+        self.grid = dict()
+        for nid,lat,lon,refcount in osmobj.nodes.itercoords():
+            coord = (lat, lon)
+            if refcount > 0:
+                self.way_node_count += 1
+                self.way_nodes.setdefault(coord, []).append(nid)
+                if self.cell_size is not None:
+                    self.grid.setdefault(self._cell(coord), []).append((coord, nid))
+            else:
+                self.free_nodes.setdefault(coord, []).append(nid)
+
+    def _cell(self, coord):
+        return (int(np.floor(coord[0] / self.cell_size)),
+                int(np.floor(coord[1] / self.cell_size)))
+
+    def free_node_ids(self):
+        '''Return a list of the ids of all nodes that are not part of a way'''
+        return [nid for nids in self.free_nodes.itervalues() for nid in nids]
+
+    def overlaps(self):
+        '''Iterate over (coord, node ids) for coordinates with more than one node'''
+        for coord,free_ids in self.free_nodes.iteritems():
+            node_ids = self.way_nodes.get(coord, []) + free_ids
+            if len(node_ids) > 1:
+                yield coord, node_ids
+        for coord,way_ids in self.way_nodes.iteritems():
+            if len(way_ids) > 1 and not self.free_nodes.has_key(coord):
+                yield coord, way_ids
+
+    def waynode_at(self, coord):
+        '''Return the id of the way node at coord, or None.
+
+        A way node with exactly the same coordinates is preferred.
+        Otherwise the closest way node within the tolerance is used.
+
+        '''
+        # This assumes that there is only one node for a given
+        # coordinates that is part of a way.
+        way_nodes = self.way_nodes.get(coord, [])
+        if len(way_nodes) > 1:
+            self.diagnostics.warn('multiple-way-nodes',
+                                  'More than one way nodes at coordinate:\n' + str(coord),
+                                  lat=coord[0], lon=coord[1], node_ids=way_nodes)
+        if len(way_nodes) > 0:
+            return way_nodes[0]
+        if self.cell_size is None:
+            return None
+
+        # Search the grid cells within the tolerance
+        coslat = np.cos(np.radians(coord[0]))
+        closest_id = None
+        closest_distance = self.tolerance
+        for cell in self._search_cells(coord):
+            for other,nid in self.grid.get(cell, ()):
+                dy = (other[0] - coord[0]) * self.meters_per_degree_lat
+                dx = (other[1] - coord[1]) * self.meters_per_degree_lon * coslat
+                distance = np.hypot(dx, dy)
+                if distance <= closest_distance:
+                    closest_id = nid
+                    closest_distance = distance
+        return closest_id
+
+    def _search_cells(self, coord):
+        '''Iterate over the grid cells within the tolerance of coord'''
+        # A degree of longitude is shorter than a degree of latitude, so
+        # more cells are needed in the east-west direction.
+        lat_cells = 1
+        lon_cells = int(np.ceil(1. / np.cos(np.radians(coord[0])))) + 1
+        center = self._cell(coord)
+        for i in range(center[0] - lat_cells, center[0] + lat_cells + 1):
+            for j in range(center[1] - lon_cells, center[1] + lon_cells + 1):
+                yield (i, j)
+
+    def tile(self, coords):
+        '''Return a CoordinateIndex with only the way nodes that
+        waynode_at() can return for the coordinates, i.e. the way nodes
+        at the coordinates and the grid cells around them.
+
+        The tile gives the same results as this index for the
+        coordinates, e.g. when matching barriers in a worker process.
+        It has no free nodes and no diagnostics.
+
+        '''
+        tile = CoordinateIndex.__new__(CoordinateIndex)
+        tile.tolerance = self.tolerance
+        tile.cell_size = self.cell_size
+        tile.diagnostics = None
+        tile.free_nodes = dict()
+        tile.way_nodes = dict()
+        tile.grid = dict()
+        for coord in coords:
+            if self.way_nodes.has_key(coord):
+                tile.way_nodes[coord] = self.way_nodes[coord]
+            if self.cell_size is not None:
+                for cell in self._search_cells(coord):
+                    if self.grid.has_key(cell):
+                        tile.grid[cell] = self.grid[cell]
+        tile.way_node_count = sum(len(nids) for nids in tile.way_nodes.itervalues())
+        return tile
+
+    def discard_free_node(self, nid, coord):
+        '''Remove a free-standing node, e.g. after it has been merged'''
+        free_ids = self.free_nodes.get(coord, [])
+        if nid in free_ids:
+            free_ids.remove(nid)
+            if len(free_ids) == 0:
+                del self.free_nodes[coord]
+
+def merge_nodes(osmobj, to_node_id, from_node_id):
+    # The ways are not changed, so the from_node must be unused
+    if osmobj.nodes.refcount(from_node_id) > 0:
+        raise ValueError(u"Can not merge node {0} which is used by ways\n".format(from_node_id).encode('utf-8'))
+    #print u"Merging into node {0} from node {1}".format(to_node_id, from_node_id)
+    to_tags = osmobj.nodes[to_node_id].tags
+    from_tags = osmobj.nodes[from_node_id].tags
+    # Check all tags before copying any, so that neither node is
+    # changed if the KeyError is caught
+    for tag in from_tags.iterkeys():
+        if to_tags.has_key(tag) and to_tags[tag] != from_tags[tag]:
+            # Conflict, as the value is different
+            errmsg = u"Conflict in merging nodes {0} and {1} for tag {2}\n".format(to_node_id, from_node_id, tag)
+            raise KeyError(errmsg.encode('utf-8'))
+    # No confict, so copy tags
+    for tag in from_tags.iterkeys():
+        to_tags[tag] = from_tags[tag]
+    # Delete the from_node
+    del osmobj.nodes[from_node_id]
+
+
+
+# Rules for converting Elveg tags to OSM tags, used by TagMapping.
+# Values in the tag dicts may contain {highwayclass}, which is replaced
+# by the highway class of the road category (vegkategori).
+elveg_tag_rules = {
+    'category2highwayclass': {'E': 'trunk',     # Europaveg
+                              'R': 'trunk',     # Riksveg
+                              'F': 'secondary', # Fylkesveg, could also be primary
+                              'K': 'road',      # Kommunal veg
+                              'P': 'road',      # Privat veg
+                              'S': 'track'},    # Skogsbilveg, possibly more info in the LBVKLASSE tag
+
+    'road_OBJTYPEs': frozenset([u'VegSenterlinje',
+                                u'Svingekonnekteringslenke',
+                                u'Kj\xf8refelt',
+                                u'Kj\xf8rebane']),
+
+    'ferry_OBJTYPEs': frozenset([u'Bilferjestrekning']),
+
+    # Road objects where a MEDIUM tag is expected
+    'medium_OBJTYPEs': frozenset([u'VegSenterlinje',
+                                  u'Svingekonnekteringslenke',
+                                  u'Kj\xf8refelt',
+                                  u'Kj\xf8rebane',
+                                  u'GangSykkelVegSenterlinje']),
+
+    # There are more vegstatus values than listed in https://wiki.openstreetmap.org/w/images/c/cc/Elveg_SOSI_4.0_2008.pdf
+    # There is a more complete list in chapter 7.3.11 in
+    # http://www.statkart.no/Documents/Standard/SOSI-standarden%20del%201%20og%202/SOSI%20standarden/Vegnett.pdf
+    'road_status': {'V': {'highway': '{highwayclass}'}, # Eksisterende veg
+                    'T': {'highway': '{highwayclass}'}, # Veg med midlertidig status
+                    'W': {'highway': '{highwayclass}'}, # Midlertidig veg mer enn et aar
+                    'A': {'highway': 'construction',
+                          'construction': '{highwayclass}'},
+                    'G': {'DEBUG': u'Veggrunn, ikke trafikkform\xe5l'},
+                    'M': {'DEBUG': u'M\xf8te- og rasteplasser'},
+                    'P': {'action': 'delete'},          # Vedtatt veg
+                    'Q': {'action': 'delete'}},         # Planlagt veg
+
+    'ferry_status': {'S': {'route': 'ferry',
+                           'class': '{highwayclass}'},
+                     'E': {'action': 'delete'},         # Vedtatt fergestrekning
+                     'F': {'action': 'delete'}},        # Planlagt fergestrekning
+
+    # Add ref to road kategories Europaveg, Riksveg and Fylkesveg
+    'category2ref': {'E': u'E {0}',
+                     'R': u'{0}',
+                     'F': u'{0}'},
+
+    'objtype': {# Gang- og sykkelveg. Only a fraction of all of those are in the data.
+                # Nevertheless, include those that are.
+                u'GangSykkelVegSenterlinje': {'highway': 'cycleway',
+                                              'foot': 'yes'},
+                # OBJTYPE=Fortau is sometimes used when a Gang- og sykkelveg goes over
+                # in a sidewalk for a while
+                # A sidewalk is usually best represented as a sidewalk=* on a road,
+                # but at least in the conversion we let it be a separate way.
+                u'Fortau': {'highway': 'footway',
+                            'footway': 'sidewalk',
+                            'note': 'Consider adding sidewalk as a tag on the road'}},
+    # TODO: OBJTYPE="Frittst\xe5ende trapp" if they look useful
 
-    osmtags = dict()
+    # Lane tags from the VKJORFLT tag
+    'lanes': {'1#2': {},                                # One lane in each direction - no special tags
+              '1': {'oneway': 'yes'},                   # One-way street along way direction
+              '2': {'oneway': '-1'},                    # One-way street opposite to way direction
+              '1#3': {'oneway': 'yes', 'lanes': '2'},
+              '2#4': {'oneway': '-1', 'lanes': '2'},
+              '1#3#5': {'oneway': 'yes', 'lanes': '3'},
+              '2#4#6': {'oneway': '-1', 'lanes': '3'},
+              '': {}},                                  # Sometimes this tag is empty -- assume that this means nothing special
+
+    # Tunnels and bridges from the MEDIUM tag
+    'medium': {'L': {'bridge': 'yes',
+                     'layer': '1'},
+               'U': {'tunnel': 'yes',
+                     'layer': '-1'},
+               # B means "through a building".
+               # This could be tagged with covered=yes (current tagging
+               # for Perleporten in Trondheim), but tunnel=building_passage
+               # seems to be preferred.
+               'B': {'tunnel': 'building_passage'}},
+
+    'source': 'Kartverket Elveg',
+    }
+
+class TagMapping(object):
+    '''Compiled conversion of Elveg tags to OSM tags.
+
+    Only a few Elveg tags (OBJTYPE, the category and status of VNR,
+    VKJORFLT and MEDIUM) decide most of the OSM tags. The OSM tags and
+    warnings for each distinct combination of those are computed once
+    from the rules and cached, and only the tags that differ between
+    ways (nvdb:id, ref, name and source:date) are added per way. The
+    tags of a way are CowTags, which share the cached tags as base,
+    with the values of the tags of the way interned in the StringTable
+    of each call. The warnings are given to the Diagnostics object of
+    each call.
 
-    # Add the nvdb:id tag from the TRANSID tag
-    # All ways should have a TRANSID (will change to LOKALID with SOSI 4.5)
-    osmtags['nvdb:id'] = elveg_tags['TRANSID']
+    '''
 
+    def __init__(self, rules=elveg_tag_rules):
+        self.rules = rules
+        self.cache = {}
 
-    # Roads and ferry routes share many tags, and are therefore
-    # treated together
-    if elveg_tags['OBJTYPE'] in roadOBJTYPEs.union([u'Bilferjestrekning']) :
+    def __call__(self, elveg_tags, diagnostics, strings):
+        '''Create tags based on standard tags in ????Elveg_default.osm'''
+        objtype = elveg_tags['OBJTYPE']
+        road_or_ferry = objtype in self.rules['road_OBJTYPEs'] or objtype in self.rules['ferry_OBJTYPEs']
 
         # Split VNR tag
         # The "vegnummer" tag is optional, but let's assume it is always present for now
         # (i.e. fix it if it causes problems)
-        if elveg_tags.has_key('VNR'):
+        if road_or_ferry and elveg_tags.has_key('VNR'):
             vegkategori,vegstatus,vegnummer = [s.strip(':;') for s in elveg_tags['VNR'].split()]
         else:
-            warn(u"VNR missing for OBJTYPE {OBJTYPE} with TRANSID {TRANSID}".format(**elveg_tags))
+            vegkategori = vegstatus = vegnummer = None
+
+        signature = (objtype, vegkategori, vegstatus,
+                     elveg_tags.get('VKJORFLT'), elveg_tags.get('MEDIUM'))
+        if not self.cache.has_key(signature):
+            self.cache[signature] = self._compile(*signature)
+        tags, warnings = self.cache[signature]
+        for code,warning in warnings:
+            diagnostics.warn(code, warning.format(vegstatus=vegstatus, **elveg_tags),
+                             transid=elveg_tags['TRANSID'])
+
+        # Add the nvdb:id tag from the TRANSID tag
+        # All ways should have a TRANSID (will change to LOKALID with SOSI 4.5)
+        osmtags = elveg_tagstore.CowTags(tags, {'nvdb:id': elveg_tags['TRANSID']})
+        if road_or_ferry and vegkategori is None:
+            # No other tags without VNR
             return osmtags
 
-        # There are more vegstatus values than listed in https://wiki.openstreetmap.org/w/images/c/cc/Elveg_SOSI_4.0_2008.pdf
-        # There is a more complete list in chapter 7.3.11 in 
-        # http://www.statkart.no/Documents/Standard/SOSI-standarden%20del%201%20og%202/SOSI%20standarden/Vegnett.pdf
-
-        if elveg_tags['OBJTYPE'] in roadOBJTYPEs:
-            # Set the road category
-            if vegstatus in ['V','T','W']: # Eksisterende veg, Veg med midlertidig status, Midlertidig veg mer enn et aar
-                osmtags['highway'] = category2highwayclass[vegkategori]
-            elif vegstatus == 'A':
-                osmtags['highway'] = 'construction'
-                osmtags['construction'] = category2highwayclass[vegkategori]
-            elif vegstatus == 'G':
-                osmtags['DEBUG'] = u'Veggrunn, ikke trafikkform\xe5l'
-            elif vegstatus == 'M':
-                osmtags['DEBUG'] = u'M\xf8te- og rasteplasser'
-            elif vegstatus in ['P','Q']: # Vedtatt veg, planlagt veg
-                osmtags['action'] = 'delete'
+        if road_or_ferry and self.rules['category2ref'].has_key(vegkategori):
+            osmtags['ref'] = strings.intern(self.rules['category2ref'][vegkategori].format(vegnummer))
+
+        # Import GATENAVN for any type of way, although it would probably only exist for road objects
+        if elveg_tags.has_key('GATENAVN'):
+            osmtags['name'] = strings.intern(elveg_tags['GATENAVN'])
+
+        # Add source date
+        if elveg_tags.has_key('DATAFANGSTDATO'):
+            date = elveg_tags['DATAFANGSTDATO']
+            osmtags['source:date'] = strings.intern('%s-%s-%s' % (date[0:4],date[4:6],date[6:8]))
+
+        return osmtags
+
+    def _compile(self, objtype, vegkategori, vegstatus, lanes, medium):
+        '''Return (tags, warnings) for a combination of Elveg tags.
+
+        The warnings are (code, template) with templates to be
+        formatted with the Elveg tags of each way.
+
+        '''
+        rules = self.rules
+        tags = dict()
+        warnings = []
+
+        # Roads and ferry routes share many tags, and are therefore
+        # treated together
+        if objtype in rules['road_OBJTYPEs'] or objtype in rules['ferry_OBJTYPEs']:
+            if vegkategori is None:
+                warnings.append(('missing-vnr', u"VNR missing for OBJTYPE {OBJTYPE} with TRANSID {TRANSID}"))
+                return tags, warnings
+            if objtype in rules['road_OBJTYPEs']:
+                status_rules = rules['road_status']
+                unknown_status = ('unknown-vegstatus', u"Unknown vegstatus {vegstatus} for TRANSID {TRANSID}")
             else:
-                warn(u"Unknown vegstatus {0} for TRANSID {1}".format(vegstatus,elveg_tags['TRANSID']))
-        elif elveg_tags['OBJTYPE'] == u'Bilferjestrekning':
-            # Set the class for the ferry route
-            if vegstatus == 'S':
-                osmtags['route'] = 'ferry'
-                osmtags['class'] = category2highwayclass[vegkategori]
-            elif vegstatus in ['E','F']: # Vedtatt fergestrekning, planlagt fergestrekning
-                osmtags['action'] = 'delete'
+                status_rules = rules['ferry_status']
+                unknown_status = ('unknown-vegstatus',
+                                  u"Ferry route with TRANSID {TRANSID} has unknown vegstatus {vegstatus}")
+            if status_rules.has_key(vegstatus):
+                for key,value in status_rules[vegstatus].iteritems():
+                    if '{highwayclass}' in value:
+                        value = value.format(highwayclass=rules['category2highwayclass'][vegkategori])
+                    tags[key] = value
             else:
-                warn(u"Ferry route with TRANSID {0} has unknown vegstatus {1}".format(elveg_tags['TRANSID'],vegstatus))
-
-        # Add ref to road kategories Europaveg, Riksveg and Fylkesveg
-        if vegkategori == 'E':
-            osmtags['ref'] = 'E ' + vegnummer
-        elif vegkategori in ['R', 'F']:
-            osmtags['ref'] = vegnummer
-
-    # Gang- og sykkelveg. Only a fraction of all of those are in the data. 
-    # Nevertheless, include those that are.
-    if elveg_tags['OBJTYPE'] == 'GangSykkelVegSenterlinje':
-        osmtags['highway'] = 'cycleway'
-        osmtags['foot'] = 'yes'
-
-    # Import GATENAVN for any type of way, although it would probably only exist for road objects
-    if elveg_tags.has_key('GATENAVN'):
-        osmtags['name'] = elveg_tags['GATENAVN']
-
-    # OBJTYPE=Fortau is sometimes used when a Gang- og sykkelveg goes over 
-    # in a sidewalk for a while
-    # A sidewalk is usually best represented as a sidewalk=* on a road,
-    # but at least in the conversion we let it be a separate way.
-    if elveg_tags['OBJTYPE'] == 'Fortau':
-        osmtags['highway'] = 'footway'
-        osmtags['footway'] = 'sidewalk' 
-        osmtags['note'] = 'Consider adding sidewalk as a tag on the road'
-    
+                warnings.append(unknown_status)
+
+        tags.update(rules['objtype'].get(objtype, {}))
+
+        # Add information about lanes from the VKJORFLT tag (oneway=*, lanes=*)
+        if lanes is not None:
+            # This probably only applies to roads and ferry routes - verify that
+            if objtype not in rules['road_OBJTYPEs'] and lanes != '1#2':
+                warnings.append(('lanes-on-non-road',
+                                 u"Processing VKJORFLT tag for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}: {VKJORFLT}"))
+            tags.update(parse_lanes(lanes, rules))
+
+        # Add information about tunnels and bridges from MEDIUM tag
+        if medium is not None:
+            # Give a warning if this tag is on a non-road object
+            if objtype not in rules['medium_OBJTYPEs']:
+                warnings.append(('medium-on-non-road',
+                                 u"Processing MEDIUM tag for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}: {MEDIUM}"))
+            if medium == 'B':
+                warnings.append(('medium-b', u"Processing MEDIUM tag 'B' for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}"))
+            if rules['medium'].has_key(medium):
+                tags.update(rules['medium'][medium])
+            else:
+                # There should be no other possible values for MEDIUM
+                warnings.append(('unknown-medium',
+                                 u"Unknown MEDIUM value '{MEDIUM}' for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}"))
 
-    # Add information about lanes from the VKJORFLT tag (oneway=*, lanes=*)
-    if elveg_tags.has_key('VKJORFLT'):
-        # This probably only applies to roads and ferry routes - verify that
-        if elveg_tags['OBJTYPE'] not in roadOBJTYPEs and elveg_tags['VKJORFLT'] != '1#2'    :
-            #print elveg_tags
-            warn(u"Processing VKJORFLT tag for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}: {VKJORFLT}".format(**elveg_tags))
-        # Use the parse_lanes() function find the correct tags
-        lane_tags = parse_lanes(elveg_tags['VKJORFLT'])
-        osmtags.update(lane_tags)
-
-    # Add information about tunnels and bridges from MEDIUM tag
-    if elveg_tags.has_key('MEDIUM'):
-        # Give a warning if this tag is on a non-road object
-        if elveg_tags['OBJTYPE'] not in roadOBJTYPEs.union([u'GangSykkelVegSenterlinje']):
-            warn(u"Processing MEDIUM tag for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}: {MEDIUM}".format(**elveg_tags))
-        if elveg_tags['MEDIUM'] == 'L':
-            osmtags['bridge'] = 'yes'
-            osmtags['layer'] = '1'
-        elif elveg_tags['MEDIUM'] == 'U':
-            osmtags['tunnel'] = 'yes'
-            osmtags['layer'] = '-1'
-        elif elveg_tags['MEDIUM'] == 'B':
-            # B means "through a building".
-            # This could be tagged with covered=yes (current tagging
-            # for Perleporten in Trondheim), but tunnel=building_passage
-            # seems to be preferred.
-            warn(u"Processing MEDIUM tag 'B' for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}".format(**elveg_tags))
-            osmtags['tunnel'] = 'building_passage'
-        else:
-            # There should be no other possible values for MEDIUM
-            warn(u"Unknown MEDIUM value '{MEDIUM}' for OBJTYPE {OBJTYPE} for TRANSID {TRANSID}".format(**elveg_tags))
-    
-    # Add source date
-    if elveg_tags.has_key('DATAFANGSTDATO'):
-        date = elveg_tags['DATAFANGSTDATO']
-        osmtags['source:date'] = '%s-%s-%s' % (date[0:4],date[4:6],date[6:8])
-    
-    osmtags['source'] = 'Kartverket Elveg'
-    # TODO: OBJTYPE="Frittst\xe5ende trapp" if they look useful
+        tags['source'] = rules['source']
+        return tags, warnings
+
+create_osmtags = TagMapping()
 
-    return osmtags
-
-def parse_lanes(lane_string):
-    lane_tags = dict()
-
-    # Early exit for the most commone values
-    if lane_string == '1#2':
-        # Most common case - one lane in each direction - no special tags
-        return lane_tags
-    elif lane_string == '1':
-        # One-way street along way direction
-        lane_tags['oneway'] = 'yes'
-        return lane_tags
-    elif lane_string == '2':
-        # One-way street opposite to way direction
-        lane_tags['oneway'] = '-1'
-        return lane_tags
-    elif lane_string == '1#3':
-        # One-way street along way direction
-        lane_tags['oneway'] = 'yes'
-        lane_tags['lanes'] = '2'
-        return lane_tags
-    elif lane_string == '2#4':
-        # One-way street along way direction
-        lane_tags['oneway'] = '-1'
-        lane_tags['lanes'] = '2'
-        return lane_tags
-    elif lane_string == '1#3#5':
-        # One-way street along way direction
-        lane_tags['oneway'] = 'yes'
-        lane_tags['lanes'] = '3'
-        return lane_tags
-    elif lane_string == '2#4#6':
-        # One-way street along way direction
-        lane_tags['oneway'] = '-1'
-        lane_tags['lanes'] = '3'
-        return lane_tags
-    elif lane_string == '':
-        # Sometimes this tag is empty -- assume that this means nothing special
-        return lane_tags
+def parse_lanes(lane_string, rules=elveg_tag_rules):
+    if rules['lanes'].has_key(lane_string):
+        return dict(rules['lanes'][lane_string])
 
     # TODO: Split lane string into individual lanes
-    # Postfix H1, H2, V1, V2 are for turning lanes, 
+    # Postfix H1, H2, V1, V2 are for turning lanes,
     # postfix K is for public service vehicles (PSV)
     # postfix O is for "waiting lanes", e.g. at ferry terminals.
-    lane_tags['note'] = "Elveg lane tags: {0}".format(lane_string)
-    return lane_tags
+    return {'note': "Elveg lane tags: {0}".format(lane_string)}
 
-def split_way(osmobj, way_id, split_points):
-    '''Split way at split points.
+def plan_split(node_distances, lats, lons, vpa_length, split_points, transid, diagnostics):
+    '''Plan the split of a way at split points.
 
-    Return list of way ids for the split way. The first id is of the
-    original way.
+    node_distances are the distances from the start of the way to
+    each node, at lats and lons, and the split points are in meters of
+    the vpa_length. Return list of cuts, in the order along the way:
+    (index, None) to split at the node with that index, or (index,
+    (lat, lon)) to split at a new node before the node with that
+    index. The cuts only depend on the arguments, so that ways can be
+    planned in parallel, see apply_split().
+
+    All split points are handled at once: one search for the nodes
+    around them, and one computation of the new node coordinates.
 
     '''
- 
-   # Do not go through the hassle, if the way needs no splitting
+    # Do not go through the hassle, if the way needs no splitting
     if len(split_points) == 0:
-        return [way_id]
+        return []
 
-    # Initialize a list of way id's of the new ways (to be returned)
-    # Since the last way is always split off first, the list will be
-    # in reverse order, and is turned around at the end.
-    splitway_id_list = []
-
-    # Get the way that is to be split
-    way = osmobj.ways[way_id]
-    transid = way.elveg_tags['TRANSID']
-
-    # Compute distances from start to each node of way
-    node_distances = osmobj.distances_from_transid(transid)
+    # Normalize split_points to geographic length, and sort them
     geo_length = node_distances[-1]
-
-    # Compute VPA length and normalize split_points to geographic length
-    if way.elveg_tags.has_key("VPA"):
-        vpa = [int(n.strip(':;')) for n in way.elveg_tags["VPA"].split()]
-    else:
-        # These roads are probably not split, so 1.0 is fine, but raise Exception for now
-        #corrction_factor = 1.0
-        raise KeyError("VPA Elveg tag not present")
-    vpa_length = vpa[2] - vpa[1]
     normalization_factor = geo_length / float(vpa_length)
-    split_points_normalized = [normalization_factor * sp for sp in split_points]
-
-    # Make sure the normalized split points are sorted
-    # (so that we can split off ways from the end of the list)
-    split_points_normalized.sort()
-
-    # Loop over the split points, splitting off the last way each time
-    while len(split_points_normalized) > 0:
-        current_split_point = split_points_normalized.pop()
-        upper_split_index = np.searchsorted(node_distances, current_split_point)
-
-        # Find the distance to the nearest nodes
-        # (for checking if a new node should be created)
-        distance_to_upper = node_distances[upper_split_index] - current_split_point
-        distance_to_lower = current_split_point - node_distances[upper_split_index - 1]
-        
-        # Decide if a new node should be created
-        # Reuse node if closer than 0.5 m
-        if distance_to_upper < 0.5 or distance_to_lower < 0.5:
-            # Verify that we have no negative distances (which is a bug)
-            if distance_to_upper < 0. or distance_to_lower < 0.:
-                warn(u"Negative distances for TRANSID {0}".format(transid))
-            # Reuse closest node
-            if distance_to_upper < distance_to_lower:
-                split_index = upper_split_index
-            else:
-                split_index = upper_split_index - 1
-            # Create a new way from the split node to the end of the way
-            newway_nodes = way.nds[split_index:]
-            newway = ElvegWay(tags=way.tags, nds=newway_nodes)
-            splitway_id_list.append(newway.id)
-            osmobj.ways[newway.id] = newway
-            
-            # Remove the new way from the old way
-            # (the split_index should be included in both ways)
-            way.nds = way.nds[:split_index + 1]
-            
-        else:
-            # Find the coordinates for the new split node
-            from_node_id = way.nds[upper_split_index - 1]
-            to_node_id = way.nds[upper_split_index]
-            from_node = osmobj.nodes[from_node_id]
-            to_node = osmobj.nodes[to_node_id]
-            ggresults = gg.Geodesic.WGS84.Inverse(from_node.lat, from_node.lon, to_node.lat, to_node.lon)
-            distance = ggresults['s12']
-            azi1 = ggresults['azi1']
-            dist_from_last_node = current_split_point - node_distances[upper_split_index - 1]
-            ggresults = gg.Geodesic.WGS84.Direct(from_node.lat, from_node.lon, azi1, dist_from_last_node)
-            newlon = ggresults['lon2']
-            newlat = ggresults['lat2']
+    points = np.sort(normalization_factor * np.asarray(split_points, dtype=float))
+
+    # Find the distance to the nearest nodes
+    # (for checking if a new node should be created)
+    upper = np.searchsorted(node_distances, points)
+    distance_to_upper = node_distances[upper] - points
+    distance_to_lower = points - node_distances[upper - 1]
+
+    # Reuse the closest node if closer than 0.5 m
+    reuse = (distance_to_upper < 0.5) | (distance_to_lower < 0.5)
+    # Verify that we have no negative distances (which is a bug)
+    negative = reuse & ((distance_to_upper < 0.) | (distance_to_lower < 0.))
+    for i in range(negative.sum()):
+        diagnostics.warn('negative-distance', u"Negative distances for TRANSID {0}".format(transid),
+                         transid=transid)
+    indexes = np.where(reuse & (distance_to_upper >= distance_to_lower), upper - 1, upper)
+
+    # Interpolate the new nodes between the nodes before and after them
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    new = np.flatnonzero(~reuse)
+    lower = upper[new] - 1
+    segment_length = node_distances[upper[new]] - node_distances[lower]
+    new_lats, new_lons = interpolate(lats[lower], lons[lower], lats[upper[new]], lons[upper[new]],
+                                     distance_to_lower[new] / segment_length)
+    for k in np.flatnonzero(segment_length > exact_distance_limit):
+        i = lower[k]
+        ggresults = gg.Geodesic.WGS84.Inverse(lats[i], lons[i], lats[i + 1], lons[i + 1])
+        ggresults = gg.Geodesic.WGS84.Direct(lats[i], lons[i], ggresults['azi1'], distance_to_lower[new[k]])
+        new_lats[k] = ggresults['lat2']
+        new_lons[k] = ggresults['lon2']
+
+    cuts = [(index, None) for index in indexes.tolist()]
+    for k, i in enumerate(new.tolist()):
+        cuts[i] = (cuts[i][0], (float(new_lats[k]), float(new_lons[k])))
+    return cuts
+
+# Base tags shared by all new nodes
+new_node_tags = {'newnode': 'yes'}
+
+def apply_split(osmobj, way_id, cuts):
+    '''Split a way with the cuts from plan_split().
+
+    Return list of way ids for the split way. The first id is of the
+    original way. The segments are split off from the end of the way,
+    so the new nodes and ways get their ids in reverse order of the
+    cuts, and the node lists of all segments are built in one pass.
+    The new ways share the tags of the way until they are changed.
 
+    '''
+    if len(cuts) == 0:
+        return [way_id]
+    way = osmobj.ways[way_id]
+    nds = way.nds
+
+    # The node at each cut, and the ids of the new ways
+    cut_nodes = [None] * len(cuts)
+    newway_ids = [None] * len(cuts)
+    for k in range(len(cuts) - 1, -1, -1):
+        index, split_coord = cuts[k]
+        if split_coord is None:
+            cut_nodes[k] = nds[index]
+        else:
             # Create the new node
-            split_node = ElvegNode(attribs={"lon": newlon, "lat": newlat})
+            newlat, newlon = split_coord
+            # TEMPORARY: newnode=yes
+            split_node = ElvegNode(attribs={"id": osmobj.ids.new_node_id(), "lon": newlon, "lat": newlat},
+                                   tags=elveg_tagstore.CowTags(new_node_tags))
             if osmobj.nodes.has_key(split_node.id):
-                # This should not happen if ElvegNode.__init__() does the right thing
+                # This should not happen if the IdAllocator does the right thing
                 raise Exception(u"Almost overwrote node {0}\n".format(split_node.id).encode('utf-8'))
             osmobj.nodes[split_node.id] = split_node
+            cut_nodes[k] = split_node.id
+        newway_ids[k] = osmobj.ids.new_way_id()
+
+    # Each segment runs from the node of one cut to the node of the
+    # next. The way nodes between them start after the node of a cut at
+    # a way node (which is shared by both segments), and at the index of
+    # a cut at a new node.
+    segments = []
+    start = 0
+    for k, (index, split_coord) in enumerate(cuts):
+        if k > 0 and split_coord is None and cuts[k - 1] == (index, None):
+            # Two split points at the same node give a segment with only that node
+            segments.append([cut_nodes[k]])
+        else:
+            segments.append(([cut_nodes[k - 1]] if k > 0 else []) + nds[start:index] + [cut_nodes[k]])
+        start = index + 1 if split_coord is None else index
+    segments.append([cut_nodes[-1]] + nds[start:])
 
-            # TEMPORARY:
-            osmobj.nodes[split_node.id].tags['newnode'] = 'yes'
+    osmobj.set_way_nodes(way, segments[0])
+    for newway_id, newway_nodes in zip(newway_ids, segments[1:]):
+        newway = ElvegWay(attribs={"id": newway_id}, tags=way.tags, nds=newway_nodes)
+        osmobj.add_way(newway)
+    return [way_id] + newway_ids
 
-            # Create a new way from the split_point to the end of the way
-            newway_nodes = [split_node.id] + way.nds[upper_split_index:]
-            newway = ElvegWay(tags=way.tags, nds=newway_nodes)
-            splitway_id_list.append(newway.id)
-            osmobj.ways[newway.id] = newway
 
-            # Remove nodes for the new way from the old way
-            way.nds = way.nds[:upper_split_index] + [split_node.id]
+class StageProfiler(object):
+    '''Record wall time, CPU time, memory and object counts per stage.
 
-    # Finally, add the original way, which is the first segment of the
-    # newly split way.
-    splitway_id_list.append(way_id)
+    Use as profiler.run(name, function, *args), which returns the
+    result of function(*args). Counts can be added to the last stage
+    with profiler.count().
 
-    # Reverse direction so that first way segment comes first
-    return splitway_id_list[::-1]
+    The process may already have converted other municipalities (e.g.
+    in a worker of elveg_all.py), so the peak memory is reset when the
+    profiler is created, where the kernel supports it, and the growth
+    of the memory since then is recorded for each stage as well.
 
+    '''
 
-    ###########################################################
-#           main                                          #
-###########################################################
-        
-# Read input arguments
-directory = sys.argv[1]
-if len(sys.argv) >= 3:
-    kommune_number = sys.argv[2]
-else:
-    kommune_number = directory.strip('/')[-4:]
-    # Check that it is really a number
-    kummune_int = int(kommune_number)
-
-
-# Find the names of the *.txt files
-osm_input = os.path.join(directory, kommune_number + 'Elveg_default.osm')
-osm_output = os.path.join(directory, kommune_number + 'Elveg.osm')
-elveg_fart = os.path.join(directory, kommune_number + 'Fart.txt')
-elveg_hoyde = os.path.join(directory, kommune_number + 'Hoyde.txt')
-osm_barrier_output = os.path.join(directory, kommune_number + 'detatched_barriers.osm')
-
-# Loop over speed limits and tags where the whole 
-# way where possible. Other places, add to split list
-roaddata = {}
-with open(elveg_fart, 'rb') as ef:
-    # Read first four header lines
-    ef_header = ef.next()
-    ef_export_line = ef.next()
-    ef_some_number = ef.next()
-    ef_empty_line = ef.next()
-    
-    # Then use csv module for reading data
-    reader = csv.DictReader(ef, delimiter=';')
-    for row in reader:
-        transid = row[' TransID']
-
-        fart_start = int(row['Fra'])
-        fart_stop =  int(row['   Til'])
-        fart_length = fart_stop - fart_start
-        fart_limit = row[' Fart']
-
-        if not roaddata.has_key(transid):
-            roaddata[transid] = {}
-        if not roaddata[transid].has_key('maxspeed'):
-            roaddata[transid]['maxspeed'] = []
-        roaddata[transid]['maxspeed'].append({'maxspeed': fart_limit,
-                                              'start': fart_start,
-                                              'stop': fart_stop})
-                                              
-# Add height limits to roaddata (if the file exists)
-if not os.path.isfile(elveg_hoyde):
-    warn(u"File {0} does not exist and is not used".format(elveg_hoyde))
-else:
-    with open(elveg_hoyde, 'rb') as eh:
-        # Read first four header lines
-        eh_header = eh.next()
-        eh_export_line = eh.next()
-        eh_empty_line1 = eh.next()
-        eh_empty_line2 = eh.next()
-
-        # Then use csv module for reading data
-        reader = csv.DictReader(eh, delimiter=';')
-        for row in reader:
-            transid = row[' TransID']
-
-            height_start = int(row['Fra'])
-            height_stop =  int(row['   Til'])
-            height_length = height_stop - height_start
-            height_limit = row['H\xf8yde']
-
-            if not roaddata.has_key(transid):
-                roaddata[transid] = {}
-            if not roaddata[transid].has_key('maxheight'):
-                roaddata[transid]['maxheight'] = []
-            roaddata[transid]['maxheight'].append({'maxheight': height_limit,
-                                                   'start': height_start,
-                                                   'stop': height_stop})
-
-# TODO: Add information from XXXXAksel.txt to roadddata,
-# and add relevant tagging.
-
-# Read OSM file
-osmobj = ElvegOSM.load(osm_input)
-
-# Loop through all nodes and move tags to elveg_tags
-for nid,node in osmobj.nodes.items():
-    node.elveg_tags = node.tags
-    node.tags = {}
-
-# Loop through all ways in osmobj and 
-# - swap original tags with OSM tags.
-# - extract the way length from the Elveg VPA tag and
-#   store in roaddata structure
-# Important to use items() instead of iteritems() here as we are adding
-# items to the obmobj.ways dictionary during the loop.
-for wid,w in osmobj.ways.items():
-    # Add new tags (using the create_osmtags function)
-    w.elveg_tags = w.tags
-    osm_tags = create_osmtags(w.elveg_tags)
-    w.tags = osm_tags
-
-    # Check that way has VPA Elveg tag
-    if not w.elveg_tags.has_key('VPA'):
-        warn(u"VPA missing for OBJTYPE {OBJTYPE} with TRANSID {TRANSID}".format(**w.elveg_tags))
-        continue
-
-    # Add way length as given by VPA to the roadddata structure
-    transid = w.elveg_tags['TRANSID']
-    vpa = [int(n.strip(':;')) for n in w.elveg_tags["VPA"].split()]
-    # We do not care about those ways where we have no data to add,
-    # so move to next if this is the case.
-    if not roaddata.has_key(transid):
-        continue
-    roaddata[transid]['length'] = vpa[2] - vpa[1]
-    
-    # make a sorted list of meter values, including end
-    # points, where some roaddata may change
-    end_points = [0, roaddata[transid]['length']]
-    for restriction_type in ['maxspeed', 'maxheight']: # Add any new restrictions here
-        for endpoint_type in ['start', 'stop']:
-            end_points.extend([d[endpoint_type] for d in roaddata[transid].get(restriction_type, [])])
-    end_points = list(set(end_points))
-    end_points.sort()
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        if enabled:
+            self.peak_reset = reset_peak_rss()
+            self.start_rss = current_rss()
+
+    def run(self, name, function, *args):
+        if not self.enabled:
+            return function(*args)
+        wall = time.time()
+        cpu = sum(os.times()[:2])
+        result = function(*args)
+        self.stages.append({'stage': name,
+                            'wall': time.time() - wall,
+                            'cpu': sum(os.times()[:2]) - cpu,
+                            'rss_mb': current_rss(),
+                            'rss_growth_mb': current_rss() - self.start_rss,
+                            'peak_rss_mb': peak_rss(),
+                            'counts': {}})
+        return result
+
+    def count(self, **counts):
+        if self.enabled:
+            self.stages[-1]['counts'].update(counts)
+
+    def report(self):
+        return {'stages': self.stages,
+                'wall': sum(s['wall'] for s in self.stages),
+                'cpu': sum(s['cpu'] for s in self.stages),
+                'start_rss_mb': self.start_rss,
+                'peak_rss_mb': max([s['peak_rss_mb'] for s in self.stages] + [0]),
+                # False if the peak may be from before the conversion
+                'peak_rss_reset': self.peak_reset}
+
+    def save(self, filename, **info):
+        report = self.report()
+        report.update(info)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+def current_rss():
+    '''Return the current resident memory of this process in MB (0 if unknown)'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except IOError:
+        return 0.
+    return pages * resource.getpagesize() / 1e6
+
+def reset_peak_rss():
+    '''Reset the peak resident memory of this process to the current
+    memory. Return False if the kernel does not support it (it needs
+    Linux 4.0 or later).'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+
+def peak_rss():
+    '''Return the peak resident memory of this process in MB, since
+    the last reset_peak_rss()'''
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def read_restriction_tables(source, kommune_number, diagnostics):
+    '''Read the restriction tables of a municipality.
+
+    source is an elveg_archive.DirectorySource or ZipSource with the
+    input files.
+
+    Return dict with restriction tags as keys and RestrictionTable
+    objects as values.
+
+    '''
+    # Read the speed and height limits (and any other registered
+    # restriction types), in columns per TRANSID
+    restriction_tables = {}
+    for restriction_type in elveg_restrictions.restriction_types:
+        filename = kommune_number + restriction_type.filename_suffix
+        if not restriction_type.required and not source.exists(filename):
+            diagnostics.warn('missing-file', u"File {0} does not exist and is not used".format(source.path(filename)),
+                             filename=source.path(filename))
+            continue
+        with source.open(filename) as f:
+            table = elveg_restrictions.read_restriction_table(f, restriction_type.value_column)
+        restriction_tables[restriction_type.tag] = table
+    return restriction_tables
+
+# The conversion of a way: the OSM tags, the warnings as (code,
+# message, fields), and for ways with restrictions, the cuts from
+# plan_split() and the tags of each segment (otherwise None)
+WayPlan = collections.namedtuple('WayPlan', ['tags', 'warnings', 'cuts', 'segment_tags'])
+
+def plan_ways(ways, restrictions):
+    '''Plan the conversion of ways, and return a list of WayPlans.
+
+    ways is a list of (elveg_tags, lats, lons), where lats and lons
+    are the coordinates of the nodes of the ways with restrictions,
+    and None for the other ways. restrictions is a dict with the
+    restrictions of those ways (a dict with a Restrictions object or
+    None per restriction tag) by TRANSID. The plans only depend on the
+    arguments, so that ways can be planned in worker processes. The
+    values of the tags of the ways are interned in a StringTable of
+    their own, so that ways with e.g. the same name share it.
+
+    '''
+    # Compute the way distances needed for splitting in one pass. The
+    # segments between the last node of one way and the first node of
+    # the next are not needed, and are skipped.
+    coords = [(lats, lons) for elveg_tags, lats, lons in ways if lats is not None]
+    if len(coords) > 0:
+        gaps = np.cumsum([len(lats) for lats, lons in coords])[:-1] - 1
+        lengths = segment_lengths(np.concatenate([lats for lats, lons in coords]),
+                                  np.concatenate([lons for lats, lons in coords]),
+                                  skip=gaps)
+    start = 0
+
+    strings = elveg_tagstore.StringTable()
+    plans = []
+    for elveg_tags, lats, lons in ways:
+        transid = elveg_tags['TRANSID']
+        warnings = elveg_diagnostics.WarningRecorder()
+        if lats is not None:
+            stop = start + len(lats)
+            way_lengths = lengths[start:stop - 1]
+            start = stop
+
+        # Add new tags (using the create_osmtags function)
+        osm_tags = create_osmtags(elveg_tags, warnings, strings)
+
+        # Check that way has VPA Elveg tag
+        if not elveg_tags.has_key('VPA'):
+            warnings.warn('missing-vpa',
+                          u"VPA missing for OBJTYPE {OBJTYPE} with TRANSID {TRANSID}".format(**elveg_tags),
+                          transid=transid)
+            plans.append(WayPlan(osm_tags, warnings.warnings, None, None))
+            continue
+
+        # Find way length as given by VPA
+        vpa = [int(n.strip(':;')) for n in elveg_tags["VPA"].split()]
+        # We do not care about those ways where we have no data to add,
+        # so move to next if this is the case.
+        if lats is None:
+            plans.append(WayPlan(osm_tags, warnings.warnings, None, None))
+            continue
+        length = vpa[2] - vpa[1]
+
+        # Find the segments where the restrictions are constant. For most
+        # ways, there will be only one segment, but whenever the speed
+        # limit changes on a way or a height restriction does not apply to
+        # the whole way, there will be more than one segment
+        segmentation = elveg_restrictions.segment_restrictions(length, restrictions[transid])
+
+        # Test endpoints from .txt files against VPA lengths
+        # There is at least one case where the end point is outside the VPA meter range
+        for end_point in segmentation.outside_points:
+            warntemplate = u"Warning: End point {0} m outside of VPA length of road ({1} m) for TRANSID {2}"
+            warnstring = warntemplate.format(end_point, length, transid)
+            warnings.warn('restriction-outside-vpa', warnstring,
+                          transid=transid, end_point=end_point, length=length)
+
+        # The node distances (and their warnings) are only needed for
+        # the ways that are split
+        if len(segmentation.split_points) > 0:
+            distances = node_distances(way_lengths, transid, warnings)
+            cuts = plan_split(distances, lats, lons, length, segmentation.split_points, transid, warnings)
+        else:
+            cuts = []
+        plans.append(WayPlan(osm_tags, warnings.warnings, cuts, segmentation.segment_tags))
+    return plans
+
+def _plan_tile(task):
+    # Pool.map only passes a single argument
+    return plan_ways(*task)
+
+def convert_ways(osmobj, restriction_tables, tiles=1):
+    '''Convert tags of all ways, and split them where the restrictions change.
+
+    The conversion of each way is planned with plan_ways(), with the
+    ways divided into tiles (by the longitude of their first node)
+    that are planned by up to tiles worker processes. The plans are
+    applied in TRANSID order, so that the new nodes and ways get the
+    same ids whatever the order of the input and the number of tiles.
+
+    '''
+    # The ways with any restrictions, i.e. the ways that may need splitting
+    roaddata_transids = set()
+    for table in restriction_tables.itervalues():
+        roaddata_transids.update(table.transids())
+
+    ways = sorted(osmobj.ways.itervalues(), key=lambda way: way.elveg_tags['TRANSID'])
+    if len(ways) == 0:
+        return
+    first_lats, first_lons = osmobj.nodes.coords([way.nds[0] for way in ways])
+    tile_of, bounds = elveg_tiles.strip_tiles(first_lons, tiles)
+    members = elveg_tiles.tile_members(tile_of, len(bounds))
+
+    # Collect the Elveg tags of the ways of each tile, and the
+    # coordinates and restrictions of the ways that may need splitting
+    tasks = []
+    for indexes in members:
+        tile_ways = []
+        tile_restrictions = dict()
+        for i in indexes:
+            way = ways[i]
+            transid = way.elveg_tags['TRANSID']
+            if transid in roaddata_transids:
+                lats, lons = osmobj.nodes.coords(way.nds)
+                tile_restrictions[transid] = dict((tag, table.get(transid))
+                                                  for tag,table in restriction_tables.iteritems())
+            else:
+                lats = lons = None
+            tile_ways.append((way.elveg_tags, lats, lons))
+        tasks.append((tile_ways, tile_restrictions))
+
+    plans = [None] * len(ways)
+    for indexes, tile_plans in zip(members, elveg_tiles.map_tiles(_plan_tile, tasks, tiles)):
+        for i, plan in zip(indexes, tile_plans):
+            plans[i] = plan
+
+    # Loop through all ways in TRANSID order and
+    # - add OSM tags created from the Elveg tags.
+    # - split the way where the restrictions change
+    for way, plan in zip(ways, plans):
+        way.tags = plan.tags
+        elveg_diagnostics.replay(plan.warnings, osmobj.diagnostics)
+        if plan.cuts is None:
+            continue
+
+        # Split the way in osmobj into the right number of segments
+        segment_ids = apply_split(osmobj, way.id, plan.cuts)
+
+        # Add nvdb:id:part subkey to each part if the Elveg segment has been split
+        if len(segment_ids) > 1:
+            for i,segment_id in enumerate(segment_ids):
+                osmobj.ways[segment_id].tags['nvdb:id:part'] = str(i)
     
-    # Test endpoints from .txt files against VPA lengths
-    # There is at least one case where the end point is outside the VPA meter range
-    # Remove end points outside the range
-    while end_points[-1] > roaddata[transid]['length']:
-        warntemplate = u"Warning: End point {0} m outside of VPA length of road ({1} m) for TRANSID {2}"
-        warnstring = warntemplate.format(end_points[-1], roaddata[transid]['length'], transid)
-        warn(warnstring)
-        end_points.pop()
-
-    # Make a list of intervals, representing the new ways after a split
-    # For most ways, there will be only one interval, but whenever
-    # the speed limit changes on a way or a height restriction
-    # does not apply to the whole way, there will be more than one interval
-    interval_list = zip(end_points[:-1],end_points[1:])
-
-    # Make a list of tags (maxheight=*, maxspeed=*)
-    # with one list entry per new way interval
-    newway_tags = [{} for i in interval_list] # I.e. a list of empty dicts
-    for i,interval in enumerate(interval_list):
-        for restriction_type in ['maxspeed', 'maxheight']: # Add any new restrictions here
-            for j,restr in enumerate(roaddata[transid].get(restriction_type, [])):
-                if restr['start'] <= interval[0] and interval[1] <= restr['stop']:
-                    newway_tags[i][restriction_type] = restr[restriction_type]
-
-    # DEBUG: Remove later
-    #print newway_tags
-
-    # Split the way in osmobj into the right number of segments
-    split_points = end_points[1:-1]
-    segment_ids = split_way(osmobj, w.id, split_points)
-
-    # Add nvdb:id:part subkey to each part if the Elveg segment has been split
-    if len(segment_ids) > 1:
+        # Add maxheight and maxspeed restrictions
         for i,segment_id in enumerate(segment_ids):
-            osmobj.ways[segment_id].tags['nvdb:id:part'] = str(i)
-    
-    # Add maxheight and maxspeed restrictions
-    for i,segment_id in enumerate(segment_ids):
-        osmobj.ways[segment_id].tags.update(newway_tags[i])
-
-# Loop through all ways and make a set of those nodes that are part of a way
-way_node_ids = set()
-for way in osmobj.ways.values():
-    way_node_ids.update(way.nds)
-# ... and those that are not part of a way
-noway_node_ids = set(osmobj.nodes).difference(way_node_ids)
-
-# Make a table with hash of indices of the nodes, in order to identify
-# nodes with (exactly) the same coordinates
-node_lookup = dict()
-node_overlaps = set()
-for id,node in osmobj.nodes.iteritems():
-    key = (node.lat, node.lon)
-    if node_lookup.has_key(key):
-        node_lookup[key].append(id)
-        node_overlaps.add(key)
-    else:
-        node_lookup[key] = [id]
-
-# DATA CHECKING: Check if any way nodes also have tags, or if all tags
-# are on duplicate nodes
-#for waynode_id in way_nodes:
-#    waynode = osmobj.nodes[waynode_id]
-#    if len(waynode.tags) > 0:
-#        print waynode.tags
-
-# DATA CHECKING: Check that no coordinates have more than two nodes
-for coord in node_overlaps:
-    if len(node_lookup[coord]) != 2:
-        print "Warning: The following (coordinates, node ids) have more than two nodes per coordinate"
-        print (coord,node_lookup[coord])
-
-# Create OSM object for manual merging of off-way barriers
-osmobj_barriers = ElvegOSM()
-
-
-# Loop through and process all single nodes
-for nid in noway_node_ids:
-    noway_node = osmobj.nodes[nid]
-    coord = (noway_node.lat, noway_node.lon)
-    if noway_node.elveg_tags['OBJTYPE'] == 'Vegsperring':
-        # Tag the barrier with OSM tags
-        vegsperringtype = noway_node.elveg_tags['VEGSPERRINGTYPE']
-        if vegsperringtype == 'Betongkjegle':
-            noway_node.tags['barrier'] = 'block'
-        elif vegsperringtype == u'Bilsperre':
-            # This seems to be any type of barrier that has wide enough
-            # openings to only stop cars.
-            noway_node.tags['barrier'] = 'yes'
-        elif vegsperringtype == u'Bussluse':
-            noway_node.tags['barrier'] = 'bus_trap'
-        elif vegsperringtype == u'L\xe5st bom':
-            noway_node.tags['barrier'] = 'gate'
-        elif vegsperringtype == u'New Jersey':
-            noway_node.tags['barrier'] = 'jersey_barrier'
-        elif vegsperringtype == u'R\xf8rgelender':
-            # This describes the material more than the actual barrier
-            # Similar to barrier=fence, but usually it is possible to
-            # walk or bike around
-            noway_node.tags['barrier'] = 'yes'
-        elif vegsperringtype == u'Steinblokk':
-            noway_node.tags['barrier'] = 'block'
-        elif vegsperringtype == u'Trafikkavviser':
-            # It seems that roads with this kind of barrier are 
-            # best tagged as footways in OSM.
-            # I suppose the barrier itself could be anything.
-            noway_node.tags['barrier'] = 'yes'
-        elif vegsperringtype == u'Ukjent':
-            noway_node.tags['barrier'] = 'yes'
-        else:
-            warn(u"Unknown barrier: {0}".format(vegsperringtype))
-            noway_node.tags['barrier'] = 'yes'
-        # Find the other waynode that has the same coordinates
-        way_node_id = waynode_from_coord(coord)
-        if way_node_id is None:
-            #sys.stderr.write('Warning: Unable to merge Vegsperring at coordinates ' + str(coord) + '\n')
-            # Write to separate OSM file instead
-            osmobj_barriers.nodes[noway_node.id] = noway_node
-            del osmobj.nodes[noway_node.id]
-        else:
-            # Merge tags into the way node
-            merge_nodes(way_node_id, noway_node.id)
-    elif noway_node.elveg_tags['OBJTYPE'] == 'Kommunedele':
-        # We do not use this tag, mark this node for deletion
-        noway_node.tags['action'] = 'delete'
-    elif noway_node.elveg_tags['OBJTYPE'] == 'Ferjekai':
-        # These nodes are not connected to the road network
-        # In OSM, they should ideally be on the node between the road and the ferry route.
-        noway_node.tags['amenity'] = 'ferry terminal'
-
-
-# TODO: Add amenity="ferry terminal" on nodes with OBJTYPE=Ferjekai
-
-# Remove all ways and non-way nodes with action=delete and delete unused nodes
-# Loop through ways, collect ways with action=delele and
-# id of nodes in ways
-toDelete = set()
-nodesUsed = set()
-for _,way in osmobj.ways.iteritems():
-    if "action" in way.tags and way.tags['action'] == 'delete':
-        toDelete.add(way)
-    else:
-        for n in way.nds:
-            nodesUsed.add(n)
-# Collects nodes which should be deleted
-for _,node in osmobj.nodes.iteritems():
-    if "action" in node.tags and node.tags['action'] == 'delete':
-        toDelete.add(node)
-    elif (node.id not in nodesUsed) and (len(node.tags)) == 0:
-        toDelete.add(node)
+            osmobj.ways[segment_id].tags.update(plan.segment_tags[i])
+
+def check_overlaps(coord_index):
+    '''Warn about coordinates with more than two nodes'''
+    # DATA CHECKING: Check if any way nodes also have tags, or if all tags
+    # are on duplicate nodes
+    #for waynode_id in coord_index.way_node_ids:
+    #    waynode = osmobj.nodes[waynode_id]
+    #    if len(waynode.tags) > 0:
+    #        print waynode.tags
+
+    # DATA CHECKING: Check that no coordinates have more than two nodes
+    for coord,node_ids in coord_index.overlaps():
+        if len(node_ids) != 2:
+            coord_index.diagnostics.warn('overlapping-nodes',
+                                         "Warning: The following (coordinates, node ids) have more than two nodes per coordinate\n"
+                                         + str((coord,node_ids)),
+                                         lat=coord[0], lon=coord[1], node_ids=node_ids)
+
+def match_barriers(coord_index, coords, tiles=1):
+    '''Return list of the id of the way node at each coordinate (or None).
+
+    With more than one tile, the coordinates are divided into tiles by
+    longitude, and matched by up to tiles worker processes, each with
+    the way nodes of the grid cells around its coordinates (see
+    CoordinateIndex.tile()).
 
-# Delete elements
-for element in toDelete:
-    osmobj.discard(element)
+    '''
+    if tiles <= 1:
+        return [coord_index.waynode_at(coord) for coord in coords]
+    tile_of, bounds = elveg_tiles.strip_tiles([lon for lat, lon in coords], tiles)
+    members = elveg_tiles.tile_members(tile_of, len(bounds))
+    tasks = []
+    for indexes in members:
+        tile_coords = [coords[i] for i in indexes]
+        tasks.append((coord_index.tile(tile_coords), tile_coords))
+    way_node_ids = [None] * len(coords)
+    for indexes, (tile_ids, warnings) in zip(members, elveg_tiles.map_tiles(_match_tile, tasks, tiles)):
+        elveg_diagnostics.replay(warnings, coord_index.diagnostics)
+        for i, way_node_id in zip(indexes, tile_ids):
+            way_node_ids[i] = way_node_id
+    return way_node_ids
+
+def _match_tile(task):
+    tile, coords = task
+    tile.diagnostics = elveg_diagnostics.WarningRecorder()
+    return [tile.waynode_at(coord) for coord in coords], tile.diagnostics.warnings
+
+def merge_barriers(osmobj, coord_index, tiles=1):
+    '''Tag free-standing nodes and merge barriers into the way nodes.
+
+    The way nodes at the barriers are found with match_barriers().
+    Return an ElvegOSM object with the barriers that could not be merged.
 
-# TODO: Add turn restrictions from XXXXSving.txt
+    '''
+    # Create OSM object for manual merging of off-way barriers
+    osmobj_barriers = ElvegOSM(diagnostics=osmobj.diagnostics)
+
+    # Find the other waynode that has the same coordinates for each barrier
+    free_node_ids = coord_index.free_node_ids()
+    barrier_ids = [nid for nid in free_node_ids
+                   if osmobj.nodes[nid].elveg_tags['OBJTYPE'] == 'Vegsperring']
+    barrier_coords = [(osmobj.nodes[nid].lat, osmobj.nodes[nid].lon) for nid in barrier_ids]
+    way_node_ids = dict(zip(barrier_ids, match_barriers(coord_index, barrier_coords, tiles)))
+
+    # Loop through and process all single nodes
+    for nid in free_node_ids:
+        noway_node = osmobj.nodes[nid]
+        coord = (noway_node.lat, noway_node.lon)
+        if noway_node.elveg_tags['OBJTYPE'] == 'Vegsperring':
+            # Tag the barrier with OSM tags
+            vegsperringtype = noway_node.elveg_tags['VEGSPERRINGTYPE']
+            if vegsperringtype == 'Betongkjegle':
+                noway_node.tags['barrier'] = 'block'
+            elif vegsperringtype == u'Bilsperre':
+                # This seems to be any type of barrier that has wide enough
+                # openings to only stop cars.
+                noway_node.tags['barrier'] = 'yes'
+            elif vegsperringtype == u'Bussluse':
+                noway_node.tags['barrier'] = 'bus_trap'
+            elif vegsperringtype == u'L\xe5st bom':
+                noway_node.tags['barrier'] = 'gate'
+            elif vegsperringtype == u'New Jersey':
+                noway_node.tags['barrier'] = 'jersey_barrier'
+            elif vegsperringtype == u'R\xf8rgelender':
+                # This describes the material more than the actual barrier
+                # Similar to barrier=fence, but usually it is possible to
+                # walk or bike around
+                noway_node.tags['barrier'] = 'yes'
+            elif vegsperringtype == u'Steinblokk':
+                noway_node.tags['barrier'] = 'block'
+            elif vegsperringtype == u'Trafikkavviser':
+                # It seems that roads with this kind of barrier are 
+                # best tagged as footways in OSM.
+                # I suppose the barrier itself could be anything.
+                noway_node.tags['barrier'] = 'yes'
+            elif vegsperringtype == u'Ukjent':
+                noway_node.tags['barrier'] = 'yes'
+            else:
+                osmobj.diagnostics.warn('unknown-barrier', u"Unknown barrier: {0}".format(vegsperringtype),
+                                        node_id=nid, barrier=vegsperringtype)
+                noway_node.tags['barrier'] = 'yes'
+            way_node_id = way_node_ids[nid]
+            if way_node_id is None:
+                #sys.stderr.write('Warning: Unable to merge Vegsperring at coordinates ' + str(coord) + '\n')
+                # Write to separate OSM file instead
+                osmobj_barriers.nodes[noway_node.id] = noway_node
+                del osmobj.nodes[noway_node.id]
+            else:
+                # Merge tags into the way node
+                try:
+                    merge_nodes(osmobj, way_node_id, noway_node.id)
+                except KeyError:
+                    # Another barrier with other tags has already been
+                    # merged into the way node, e.g. one within the
+                    # tolerance of the same node
+                    osmobj.diagnostics.warn('barrier-conflict',
+                                            u"Barrier {0} conflicts with the tags of way node {1}, not merged".format(nid, way_node_id),
+                                            node_id=nid, way_node_id=way_node_id, barrier=vegsperringtype)
+                    osmobj_barriers.nodes[noway_node.id] = noway_node
+                    del osmobj.nodes[noway_node.id]
+            coord_index.discard_free_node(noway_node.id, coord)
+        elif noway_node.elveg_tags['OBJTYPE'] == 'Kommunedele':
+            # We do not use this tag, mark this node for deletion
+            noway_node.tags['action'] = 'delete'
+        elif noway_node.elveg_tags['OBJTYPE'] == 'Ferjekai':
+            # These nodes are not connected to the road network
+            # In OSM, they should ideally be on the node between the road and the ferry route.
+            noway_node.tags['amenity'] = 'ferry terminal'
+
+    return osmobj_barriers
+
+def delete_unused(osmobj):
+    '''Delete elements with action=delete, and nodes not used by any way'''
+    # Remove all ways with action=delete, which also removes their
+    # references to their nodes
+    for way in [w for w in osmobj.ways.itervalues() if w.tags.get('action') == 'delete']:
+        osmobj.remove_way(way)
+
+    # Remove nodes with action=delete, and untagged nodes that are not
+    # used by any way, in one pass over the nodes
+    def keep(refcount, tags):
+        if tags.get('action') == 'delete':
+            return False
+        return refcount > 0 or len(tags) > 0
+    osmobj.nodes.compact(keep)
+
+
+def convert_municipality(directory, kommune_number, osm_input=None, output_format='osm',
+                         profile=False, id_block=None, id_block_size=10**7, warning_limit=100,
+                         source=None, tiles=1, drop_elveg_tags=False, previous=None):
+    '''Convert the Elveg data of a municipality.
+
+    osm_input is the output of sosi2osm, as a file name or file object,
+    and is XXXXElveg_default.osm of the source by default. A file
+    (name) ending in .SOS is read directly, without sosi2osm. The
+    restriction tables are read from source, an
+    elveg_archive.DirectorySource or ZipSource, which is dir by
+    default, so that the inputs can be read from the zip archives
+    without extracting them. With tiles, the ways and barriers are
+    divided into that many tiles, which are converted in parallel (see
+    convert_ways() and match_barriers()). The results are written to
+    dir/XXXXElveg.FORMAT and dir/XXXXdetatched_barriers.FORMAT, and with
+    profile, the profile report to dir/XXXXelveg2osm_profile.json.
+    With id_block, the ids are in that block of id_block_size ids (see
+    IdAllocator), and otherwise the ids of the input are kept. With
+    drop_elveg_tags, the Elveg tags of the ways are freed after the ways
+    are converted, and those of the nodes after the barriers are
+    merged, to save memory.
+
+    With previous, the XXXXElveg output of the previous delivery, the
+    changes from it are written as osmChange to dir/XXXXElveg.osc (see
+    elveg_diff).
+
+    Warnings are written to standard error, at most warning_limit of
+    each kind (None for all, see elveg_diagnostics.Diagnostics), and
+    to dir/XXXXelveg2osm_diagnostics.jsonl, which ends with the
+    number of warnings of each kind.
+
+    Nothing is kept in module globals, so several municipalities can be
+    converted in the same process. Return the StageProfiler and the
+    numbers of changed elements (see elveg_diff.diff_osm_files()), or
+    None without previous.
 
-osmobj.save(osm_output)
-osmobj_barriers.save(osm_barrier_output)
+    '''
+    # Find the names of the *.osm files
+    if source is None:
+        source = elveg_archive.DirectorySource(directory)
+    opened_input = osm_input is None
+    if opened_input:
+        osm_input = source.open(kommune_number + 'Elveg_default.osm')
+    osm_output = os.path.join(directory, kommune_number + 'Elveg.' + output_format)
+    osm_barrier_output = os.path.join(directory, kommune_number + 'detatched_barriers.' + output_format)
+    profile_output = os.path.join(directory, kommune_number + 'elveg2osm_profile.json')
+    diagnostics_output = os.path.join(directory, kommune_number + 'elveg2osm_diagnostics.jsonl')
+    change_output = os.path.join(directory, kommune_number + 'Elveg.osc')
+
+    ids = IdAllocator(id_block, id_block_size)
+    profiler = StageProfiler(profile)
+    diagnostics = elveg_diagnostics.Diagnostics(jsonl_file=open(diagnostics_output, 'w'),
+                                                limit=warning_limit)
+
+    # Close the diagnostics also if a stage fails, so that the buffered
+    # warnings and the counts are written for the failed municipality
+    try:
+        restriction_tables = profiler.run('read_tables', read_restriction_tables, source, kommune_number,
+                                          diagnostics)
+        profiler.count(restrictions=sum(len(t) for t in restriction_tables.itervalues()))
+
+        # TODO: Register XXXXAksel.txt in elveg_restrictions,
+        # and add relevant tagging.
+
+        # Read OSM file, or the SOSI file directly. File objects of files
+        # and zip archive members have the file name as name.
+        input_name = getattr(osm_input, 'name', osm_input)
+        if isinstance(input_name, basestring) and input_name.lower().endswith('.sos'):
+            osmobj = profiler.run('load', ElvegOSM.load_sosi, osm_input, ids, diagnostics)
+        else:
+            osmobj = profiler.run('load', ElvegOSM.iterload, osm_input, ids, diagnostics)
+        if opened_input:
+            osm_input.close()
+        profiler.count(nodes=len(osmobj.nodes), ways=len(osmobj.ways))
+
+        nways = len(osmobj.ways)
+        profiler.run('convert_ways', convert_ways, osmobj, restriction_tables, tiles)
+        profiler.count(ways=len(osmobj.ways), split_segments=len(osmobj.ways) - nways)
+        if drop_elveg_tags:
+            # Only the barriers need their Elveg tags after this
+            osmobj.drop_elveg_tags(nodes=False)
+
+        # Index nodes by coordinate, in order to identify way nodes and
+        # free-standing nodes with (nearly) the same coordinates
+        coord_index = profiler.run('coordinate_index', CoordinateIndex, osmobj, barrier_merge_tolerance)
+        profiler.count(way_nodes=coord_index.way_node_count)
+        check_overlaps(coord_index)
+
+        nnodes = len(osmobj.nodes)
+        osmobj_barriers = profiler.run('merge_barriers', merge_barriers, osmobj, coord_index, tiles)
+        profiler.count(merged_barriers=nnodes - len(osmobj.nodes) - len(osmobj_barriers.nodes),
+                       detached_barriers=len(osmobj_barriers.nodes))
+        if drop_elveg_tags:
+            osmobj.drop_elveg_tags()
+            osmobj_barriers.drop_elveg_tags()
+
+        # TODO: Add amenity="ferry terminal" on nodes with OBJTYPE=Ferjekai
+
+        nnodes = len(osmobj.nodes)
+        nways = len(osmobj.ways)
+        profiler.run('delete_unused', delete_unused, osmobj)
+        profiler.count(deleted_nodes=nnodes - len(osmobj.nodes),
+                       deleted_ways=nways - len(osmobj.ways))
+
+        # TODO: Add turn restrictions from XXXXSving.txt
+
+        profiler.run('save', osmobj.stream_save, osm_output)
+        profiler.count(nodes=len(osmobj.nodes), ways=len(osmobj.ways))
+        osmobj_barriers.stream_save(osm_barrier_output)
+    finally:
+        diagnostics.close()
+
+    counts = None
+    if previous is not None:
+        # Free the converted data before loading both outputs
+        del osmobj, osmobj_barriers, coord_index
+        counts = profiler.run('diff', elveg_diff.diff_osm_files, previous, osm_output, change_output)
+        profiler.count(**dict((action, sum(counts[action].itervalues())) for action in counts))
+
+    if profile:
+        profiler.save(profile_output, kommune_number=kommune_number)
+    return profiler, counts
 
 
+    ###########################################################
+#           main                                          #
+###########################################################
 
+if __name__ == '__main__':
+    # Read input arguments
+    parser = argparse.ArgumentParser(usage='elveg2osm.py [--profile] [--input FILE] [--format FORMAT] [--id-block N] '
+                                     '[--tiles N] [--warning-limit N] [--drop-elveg-tags] [--diff PREVIOUS] dir [XXXX]')
+    parser.add_argument('directory')
+    parser.add_argument('kommune_number', nargs='?')
+    parser.add_argument('--input', metavar='FILE',
+                        help='Read sosi2osm output from FILE (- for stdin) instead of dir/XXXXElveg_default.osm. '
+                        'A FILE ending in .SOS is read directly, without sosi2osm')
+    parser.add_argument('--format', choices=elveg_osmio.output_formats, default='osm',
+                        help='Format of the output files XXXXElveg.FORMAT and XXXXdetatched_barriers.FORMAT')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write time and memory use per stage to XXXXelveg2osm_profile.json')
+    parser.add_argument('--id-block', type=int, metavar='N',
+                        help='Use ids in block N, e.g. the kommune number, so that the ids '
+                        'do not clash with other municipalities')
+    parser.add_argument('--id-block-size', type=int, default=10**7)
+    parser.add_argument('--tiles', type=int, default=1, metavar='N',
+                        help='Divide the municipality into N tiles, which are converted by N processes')
+    parser.add_argument('--warning-limit', type=int, default=100, metavar='N',
+                        help='Write at most N warnings of each kind (and then a sample), '
+                        '-1 for all warnings')
+    parser.add_argument('--drop-elveg-tags', action='store_true',
+                        help='Free the Elveg tags when they are no longer needed, to save memory')
+    parser.add_argument('--diff', metavar='PREVIOUS',
+                        help='Write the changes from PREVIOUS, the XXXXElveg output of the previous '
+                        'delivery, as osmChange to XXXXElveg.osc')
+    args = parser.parse_args()
+    directory = args.directory
+    if args.kommune_number is not None:
+        kommune_number = args.kommune_number
+    else:
+        kommune_number = directory.strip('/')[-4:]
+        # Check that it is really a number
+        kummune_int = int(kommune_number)
 
+    if args.input == '-':
+        osm_input = sys.stdin
+    else:
+        osm_input = args.input
+
+    warning_limit = args.warning_limit if args.warning_limit >= 0 else None
+    profiler, counts = convert_municipality(directory, kommune_number, osm_input, args.format, args.profile,
+                                            args.id_block, args.id_block_size, warning_limit, tiles=args.tiles,
+                                            drop_elveg_tags=args.drop_elveg_tags, previous=args.diff)
+    if counts is not None:
+        for action in ('create', 'modify', 'delete'):
+            print "Changes {0}: {1} nodes, {2} ways".format(action, counts[action]['node'],
+                                                             counts[action]['way'])
@@ -1,46 +1,555 @@
 #! /usr/bin/env python2
 
-'''elveg_all Elveg_archive.zip [XXXX [YYYY [...]]]'''
+'''elveg_all [--jobs N] [--force] [--profile] [--format FORMAT] [--id-blocks] [--tiles N] [--warning-limit N] [--drop-elveg-tags] [--resume] [--diff] [--native-sosi | --keep-default-osm] [--merge national.osm] Elveg_archive.zip [XXXX [YYYY [...]]]'''
 
 import sys
 import os
+import time
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import traceback
+import subprocess
+import multiprocessing
+import elveg2osm
+import elveg_merge
+import elveg_osmio
+import elveg_diagnostics
+import elveg_archive
 
-filename = sys.argv[1]
+# Manifest of input hashes and output files of converted municipalities
+cache_manifest_name = 'elveg_cache.json'
 
-# Unzip archive if necessary
+# Status, time and output sizes of each municipality of the last run
+run_manifest_name = 'elveg_run.json'
+
+# Aggregated profile reports of all municipalities
+profile_summary_name = 'elveg_profile.json'
+
+# Aggregated warning counts of all municipalities
+diagnostics_summary_name = 'elveg_diagnostics.json'
+
+def file_hash(source, digest=None):
+    '''Update digest (a new sha1 by default) with the contents of a file
+    name or file object'''
+    if digest is None:
+        digest = hashlib.sha1()
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            return file_hash(f, digest)
+    while True:
+        block = source.read(1 << 20)
+        if not block:
+            break
+        digest.update(block)
+    return digest
+
+def converter_modules():
+    '''Return the file names of the modules of this directory that are
+    imported, i.e. this script and the modules of the conversion, but
+    not e.g. the benchmarks'''
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    filenames = set()
+    for module in sys.modules.values():
+        filename = getattr(module, '__file__', None)
+        if filename is None or os.path.dirname(os.path.abspath(filename)) != script_dir:
+            continue
+        filenames.add(os.path.splitext(os.path.abspath(filename))[0] + '.py')
+    return sorted(filenames)
+
+def converter_version():
+    '''Return a hash of the converter modules and sosi2osm rules'''
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for filename in sorted(converter_modules() +
+                           glob.glob(os.path.join(script_dir, '*.lua'))):
+        digest.update(os.path.basename(filename))
+        file_hash(filename, digest)
+    return digest.hexdigest()
+
+def input_hash(source, kn, version):
+    '''Return a hash of all inputs for the conversion of a municipality.
+
+    source is the elveg_archive source with the files of the
+    municipality.
+
+    '''
+    digest = hashlib.sha1(version)
+    for filename in [kn + 'Elveg.SOS', kn + 'Fart.txt', kn + 'Hoyde.txt']:
+        digest.update(filename)
+        if source.exists(filename):
+            with source.open(filename) as f:
+                file_hash(f, digest)
+    return digest.hexdigest()
+
+def sosi_file(source, kn, kommune_dir):
+    '''Return the file name of the SOSI file of a municipality for
+    sosi2osm, which can only read files. Return (file name, temporary),
+    where temporary is True if the file has been extracted from a zip
+    archive for sosi2osm, and should be removed afterwards.
+
+    '''
+    sosiname = kn + 'Elveg.SOS'
+    if isinstance(source, elveg_archive.DirectorySource):
+        return source.path(sosiname), False
+    sosifile = os.path.join(kommune_dir, sosiname)
+    with source.open(sosiname) as src:
+        with open(sosifile, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    return sosifile, True
+
+def output_files(dirname, kn, output_format='osm'):
+    kommune_dir = os.path.join(dirname, kn)
+    return [os.path.join(kommune_dir, kn + 'Elveg.' + output_format),
+            os.path.join(kommune_dir, kn + 'detatched_barriers.' + output_format)]
+
+def output_sizes(dirname, kn, output_format='osm'):
+    '''Return dict of output file names and sizes, or None if any is missing'''
+    sizes = {}
+    for filename in output_files(dirname, kn, output_format):
+        if not os.path.isfile(filename):
+            return None
+        sizes[os.path.basename(filename)] = os.path.getsize(filename)
+    return sizes
+
+def load_manifest(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def save_manifest(filename, manifest):
+    # Write to a temporary file first, so that an interrupted run
+    # never leaves a truncated manifest
+    tmpfilename = filename + '.tmp'
+    with open(tmpfilename, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmpfilename, filename)
+
+def expected_durations(kommune_numbers, durations, sizes):
+    '''Return dict with the expected conversion time of each municipality.
+
+    durations are the times of earlier conversions, and sizes the sizes
+    of the inputs (e.g. XXXXElveg.zip). Municipalities that have not
+    been converted before are estimated from their size, with the
+    average time per byte of the others.
+
+    '''
+    known = [kn for kn in kommune_numbers if durations.has_key(kn) and sizes.get(kn, 0) > 0]
+    known_size = sum(sizes[kn] for kn in known)
+    if known_size > 0:
+        seconds_per_byte = sum(durations[kn] for kn in known) / float(known_size)
+    else:
+        seconds_per_byte = 1.
+    expected = {}
+    for kn in kommune_numbers:
+        if durations.has_key(kn):
+            expected[kn] = durations[kn]
+        else:
+            expected[kn] = sizes.get(kn, 0) * seconds_per_byte
+    return expected
+
+def convert_municipality(dirname, kn, version, cached=None, profile=False, keep_default_osm=False,
+                         native_sosi=False, output_format='osm', id_blocks=False, warning_limit=100,
+                         archive=None, tiles=1, drop_elveg_tags=False, diff=False):
+    '''Convert a single municipality.
+
+    The inputs are read from archive, the national archive as a zip
+    file or the directory it has been extracted to (dirname by
+    default), without extracting them (see
+    elveg_archive.municipality_source()). The outputs are written to
+    the directory dirname/XXXX.
+
+    The conversion is skipped if the inputs have the same hash as in
+    the cached manifest entry and the cached outputs are unchanged.
+
+    Return a tuple (kommune number, exit status, log file, input hash,
+    skipped, duration), where the exit status is the first non-zero
+    status of sosi2osm and the conversion, or 0, and duration is the
+    wall time in seconds. If the inputs can not be read (e.g. a corrupt
+    XXXXElveg.zip), the error is written to the log and the status is
+    1. The conversion is done in this
+    process by elveg2osm.convert_municipality(), with its output
+    redirected to the log. With profile, a profile report is written
+    next to the log.
+
+    The output of sosi2osm is parsed while it is produced, unless
+    keep_default_osm is set, in which case it is written to
+    XXXXElveg_default.osm first. With native_sosi, the SOSI file is
+    read directly, and sosi2osm is not used. The outputs are written
+    in output_format (see elveg_osmio.output_formats). With id_blocks,
+    the kommune number is used as the id block of the municipality
+    (see elveg2osm.IdAllocator). At most warning_limit warnings of
+    each kind are written to the log. With tiles, the conversion is
+    divided into that many tiles, converted by as many processes (see
+    elveg2osm.convert_ways()). With drop_elveg_tags, the Elveg tags are
+    freed once the conversion no longer needs them.
+
+    With diff, the changes from the previous output of the municipality
+    are written to XXXXElveg.osc (see elveg_diff). The previous output
+    is kept as XXXXElveg_previous.FORMAT during the conversion, and put
+    back if it fails. An XXXXElveg.osc of an earlier run is removed, also
+    when the conversion is skipped.
+
+    '''
+    start = time.time()
+    if archive is None:
+        archive = dirname
+    kommune_dir = os.path.join(dirname, kn)
+    if not os.path.isdir(kommune_dir):
+        os.makedirs(kommune_dir)
+    osmfile = os.path.join(kommune_dir, kn + 'Elveg_default.osm')
+    logfile = os.path.join(kommune_dir, kn + 'elveg2osm.log')
+
+    source = None
+    try:
+        source = elveg_archive.municipality_source(archive, kn)
+        digest = input_hash(source, kn, version)
+    except Exception:
+        # E.g. a missing or corrupt XXXXElveg.zip
+        log_exception(logfile)
+        if source is not None:
+            source.close()
+        return kn, 1, logfile, None, False, time.time() - start
+    change_file = os.path.join(kommune_dir, kn + 'Elveg.osc')
+    if diff and os.path.isfile(change_file):
+        os.remove(change_file)
+    if (cached is not None and cached['inputs'] == digest
+        and cached['outputs'] == output_sizes(dirname, kn, output_format)):
+        source.close()
+        return kn, 0, logfile, digest, True, time.time() - start
+
+    id_block = int(kn) if id_blocks else None
+    osm_output = output_files(dirname, kn, output_format)[0]
+    previous = None
+    if diff and os.path.isfile(osm_output):
+        previous = os.path.join(kommune_dir, kn + 'Elveg_previous.' + output_format)
+        os.rename(osm_output, previous)
+    if native_sosi:
+        with source.open(kn + 'Elveg.SOS') as sosi:
+            status = run_logged(logfile, elveg2osm.convert_municipality,
+                                kommune_dir, kn, sosi, output_format, profile, id_block,
+                                warning_limit=warning_limit, source=source, tiles=tiles,
+                                drop_elveg_tags=drop_elveg_tags, previous=previous)
+        finish_diff(previous, osm_output, status)
+        source.close()
+        return kn, status, logfile, digest, False, time.time() - start
+
+    # Convert SOSI file to OSM using sosi2osm
+    sosifile, temporary = sosi_file(source, kn, kommune_dir)
+    if keep_default_osm:
+        try:
+            with open(osmfile, 'wb') as f:
+                status = subprocess.call(['sosi2osm', sosifile, 'default.lua'], stdout=f)
+        except OSError:
+            # E.g. sosi2osm is not installed
+            log_exception(logfile)
+            status = 1
+        if status == 0:
+            status = run_logged(logfile, elveg2osm.convert_municipality,
+                                kommune_dir, kn, osmfile, output_format, profile, id_block,
+                                warning_limit=warning_limit, source=source, tiles=tiles,
+                                drop_elveg_tags=drop_elveg_tags, previous=previous)
+    else:
+        # Parse the output of sosi2osm while it is produced
+        try:
+            sosi2osm = subprocess.Popen(['sosi2osm', sosifile, 'default.lua'], stdout=subprocess.PIPE)
+        except OSError:
+            # E.g. sosi2osm is not installed
+            log_exception(logfile)
+            status = 1
+        else:
+            status = run_logged(logfile, elveg2osm.convert_municipality,
+                                kommune_dir, kn, sosi2osm.stdout, output_format, profile, id_block,
+                                warning_limit=warning_limit, source=source, tiles=tiles,
+                                drop_elveg_tags=drop_elveg_tags, previous=previous)
+            # Close the pipe, so that sosi2osm gets SIGPIPE if the conversion
+            # stopped early
+            sosi2osm.stdout.close()
+            sosi2osm_status = sosi2osm.wait()
+            if sosi2osm_status != 0:
+                status = sosi2osm_status
+    if temporary:
+        os.remove(sosifile)
+    finish_diff(previous, osm_output, status)
+    source.close()
+    return kn, status, logfile, digest, False, time.time() - start
+
+def finish_diff(previous, osm_output, status):
+    '''Remove the previous output after a successful conversion, and
+    put it back otherwise'''
+    if previous is None:
+        return
+    if status == 0:
+        os.remove(previous)
+    else:
+        os.rename(previous, osm_output)
+
+def log_exception(logfile):
+    '''Write the exception being handled to logfile'''
+    with open(logfile, 'w') as log:
+        traceback.print_exc(file=log)
+
+def run_logged(logfile, function, *args, **kwargs):
+    '''Call function(*args, **kwargs) with standard output and error written to logfile.
+
+    Return 0, or 1 if the function raised an exception, which is
+    written to the log.
+
+    '''
+    stdout = sys.stdout
+    stderr = sys.stderr
+    with open(logfile, 'w') as log:
+        sys.stdout = sys.stderr = log
+        try:
+            function(*args, **kwargs)
+            return 0
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+
+def aggregate_profiles(dirname, kommune_numbers):
+    '''Collect the profile reports of the municipalities into one summary.
+
+    Return the summary, which has the totals of each municipality and
+    of each stage across all municipalities.
+
+    '''
+    municipalities = {}
+    stages = {}
+    for kn in kommune_numbers:
+        filename = os.path.join(dirname, kn, kn + 'elveg2osm_profile.json')
+        if not os.path.isfile(filename):
+            continue
+        with open(filename) as f:
+            report = json.load(f)
+        municipalities[kn] = {'wall': report['wall'],
+                              'cpu': report['cpu'],
+                              'peak_rss_mb': report['peak_rss_mb'],
+                              'stages': dict((s['stage'], s['wall']) for s in report['stages'])}
+        for stage in report['stages']:
+            total = stages.setdefault(stage['stage'], {'wall': 0., 'cpu': 0., 'slowest': None})
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+            if total['slowest'] is None or stage['wall'] > municipalities[total['slowest']]['stages'][stage['stage']]:
+                total['slowest'] = kn
+    slowest = sorted(municipalities, key=lambda kn: municipalities[kn]['wall'], reverse=True)
+    return {'municipalities': municipalities,
+            'stages': stages,
+            'slowest': slowest}
+
+def aggregate_diagnostics(dirname, kommune_numbers):
+    '''Collect the warning counts of the municipalities into one summary.
+
+    Return the summary, which has the counts of each municipality, the
+    total count of each kind of warning, and the municipality with the
+    most warnings of each kind.
+
+    '''
+    municipalities = {}
+    for kn in kommune_numbers:
+        filename = os.path.join(dirname, kn, kn + 'elveg2osm_diagnostics.jsonl')
+        if not os.path.isfile(filename):
+            continue
+        summary = elveg_diagnostics.read_summary(filename)
+        if summary is not None:
+            municipalities[kn] = summary
+    summary = elveg_diagnostics.aggregate_summaries(municipalities)
+    summary['municipalities'] = dict((kn, m['counts']) for kn,m in municipalities.iteritems())
+    return summary
+
+def _convert_municipality_star(args):
+    # Pool.imap_unordered only passes a single argument, which is
+    # the positional arguments and a dict of options
+    return convert_municipality(*args[:-1], **args[-1])
+
+
+parser = argparse.ArgumentParser(usage=__doc__)
+parser.add_argument('filename')
+parser.add_argument('kommune_numbers', nargs='*')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='Number of municipalities to convert at the same time')
+parser.add_argument('-f', '--force', action='store_true',
+                    help='Convert all municipalities, even if the inputs are unchanged')
+parser.add_argument('--keep-default-osm', action='store_true',
+                    help='Write the sosi2osm output to XXXXElveg_default.osm instead of piping it')
+parser.add_argument('--native-sosi', action='store_true',
+                    help='Read the SOSI files with elveg2osm.py itself instead of sosi2osm')
+parser.add_argument('--format', choices=elveg_osmio.output_formats, default='osm',
+                    help='Format of the output files of each municipality')
+parser.add_argument('--id-blocks', action='store_true',
+                    help='Give each municipality its own range of ids, based on the kommune number, '
+                    'and keep the ids when merging')
+parser.add_argument('--tiles', type=int, default=1, metavar='N',
+                    help='Divide each municipality into N tiles, converted by N processes. '
+                    'Only used without --jobs, as the workers of --jobs can not start processes')
+parser.add_argument('--warning-limit', type=int, default=100, metavar='N',
+                    help='Write at most N warnings of each kind to the log of a municipality, '
+                    '-1 for all warnings. All warnings are counted in ' + diagnostics_summary_name)
+parser.add_argument('--drop-elveg-tags', action='store_true',
+                    help='Free the Elveg tags when they are no longer needed, to save memory')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue the last run (see ' + run_manifest_name + '), without converting '
+                    'the municipalities it has finished again')
+parser.add_argument('--diff', action='store_true',
+                    help='Write the changes from the previous output of each municipality '
+                    'as osmChange to XXXXElveg.osc')
+parser.add_argument('--merge', metavar='OUTPUT',
+                    help='Merge all converted municipalities into this file, '
+                    'in the format given by the extension (.osm, .osm.gz, .osm.bz2 or .osm.pbf)')
+parser.add_argument('--profile', action='store_true',
+                    help='Record time and memory use per stage, and summarize in ' + profile_summary_name)
+args = parser.parse_args()
+
+filename = args.filename
+
+# The inputs are read directly from the zip archive, and the outputs
+# are written to a directory with the same name
 if filename[-4:] == '.zip':
-    # Assume that it is a zip file
     dirname = filename[:-4]
     if not os.path.isdir(dirname):
         os.mkdir(dirname)
-        os.system('unzip -d {0} {1}'.format(dirname, filename))
 else:
     dirname = filename
 
-# Decide which kommunes to work on    
-if len(sys.argv) > 2:
-    kommune_numbers = sys.argv[2:]
+# Decide which kommunes to work on
+archive = elveg_archive.open_source(filename)
+if len(args.kommune_numbers) > 0:
+    kommune_numbers = args.kommune_numbers
 else:
-    allfiles = os.listdir(dirname)
-    kommune_numbers = [fn[0:4] for fn in allfiles if fn [4:] == 'Elveg.zip']
+    kommune_numbers = [fn[0:4] for fn in archive.names() if fn [4:] == 'Elveg.zip']
     kommune_numbers.sort()
+# The sizes of the inputs, for estimating the time of new municipalities
+sizes = dict((kn, archive.size(kn + 'Elveg.zip')) for kn in kommune_numbers
+             if archive.exists(kn + 'Elveg.zip'))
+archive.close()
 
-# Iterate over municipalities
+# Read hashes of the inputs of earlier runs
+manifest_file = os.path.join(dirname, cache_manifest_name)
+manifest = load_manifest(manifest_file)
+version = converter_version()
+# The outputs are different with id blocks, and with the SOSI reader of
+# elveg2osm.py instead of sosi2osm (other ids)
+if args.id_blocks:
+    version += '-id-blocks'
+if args.native_sosi:
+    version += '-native-sosi'
+
+# Iterate over municipalities, either one at a time in this process or in
+# a pool of worker processes, which each convert many municipalities
+options = {'profile': args.profile,
+           'keep_default_osm': args.keep_default_osm,
+           'native_sosi': args.native_sosi,
+           'output_format': args.format,
+           'id_blocks': args.id_blocks,
+           'warning_limit': args.warning_limit if args.warning_limit >= 0 else None,
+           'archive': filename,
+           'tiles': args.tiles,
+           'drop_elveg_tags': args.drop_elveg_tags,
+           'diff': args.diff}
+
+# The run manifest has the status ('pending', 'done', 'skipped' or
+# 'failed'), the time in seconds and the output sizes of each
+# municipality of the run, and is saved after each municipality. A run
+# can only be resumed with the same converter and options.
+run_manifest_file = os.path.join(dirname, run_manifest_name)
+last_run = load_manifest(run_manifest_file)
+if args.resume and (last_run.get('version') != version or last_run.get('options') != options):
+    sys.stdout.write("Can not resume the last run, as the converter or options have changed\n")
+    args.resume = False
+run = {'version': version,
+       'options': options,
+       'municipalities': {}}
 for kn in kommune_numbers:
-    sys.stdout.write("Processing municipality: {0}\n".format(kn))
+    entry = last_run.get('municipalities', {}).get(kn, {})
+    if args.resume and entry.get('status') in ('done', 'skipped'):
+        run['municipalities'][kn] = entry
+    else:
+        run['municipalities'][kn] = {'status': 'pending'}
+save_manifest(run_manifest_file, run)
+
+# Start the municipalities that are expected to take longest first, so
+# that a large municipality does not run alone at the end. The cache
+# manifest has the time of the last conversion of each municipality.
+durations = dict((kn, entry['duration']) for kn,entry in manifest.iteritems()
+                 if entry.has_key('duration'))
+expected = expected_durations(kommune_numbers, durations, sizes)
+tasks = []
+for kn in sorted(kommune_numbers, key=lambda kn: (-expected[kn], kn)):
+    if run['municipalities'][kn]['status'] != 'pending':
+        sys.stdout.write("Skipped municipality finished in the last run: {0}\n".format(kn))
+    elif args.force:
+        tasks.append((dirname, kn, version, None, options))
+    else:
+        tasks.append((dirname, kn, version, manifest.get(kn), options))
+if args.jobs > 1:
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.imap_unordered(_convert_municipality_star, tasks)
+else:
+    pool = None
+    results = (_convert_municipality_star(task) for task in tasks)
+
+failed = []
+for kn, status, logfile, digest, skipped, duration in results:
+    entry = run['municipalities'][kn]
+    entry['duration'] = duration
+    if skipped:
+        sys.stdout.write("Skipped unchanged municipality: {0}\n".format(kn))
+        entry['status'] = 'skipped'
+        entry['outputs'] = output_sizes(dirname, kn, args.format)
+    elif status == 0:
+        sys.stdout.write("Processed municipality: {0} in {1:.1f} s (log: {2})\n".format(kn, duration, logfile))
+        manifest[kn] = {'inputs': digest, 'outputs': output_sizes(dirname, kn, args.format),
+                        'duration': duration}
+        save_manifest(manifest_file, manifest)
+        entry['status'] = 'done'
+        entry['outputs'] = manifest[kn]['outputs']
+    else:
+        sys.stdout.write("Failed municipality: {0} with status {1} (log: {2})\n".format(kn, status, logfile))
+        failed.append(kn)
+        if manifest.has_key(kn):
+            del manifest[kn]
+            save_manifest(manifest_file, manifest)
+        entry['status'] = 'failed'
+    save_manifest(run_manifest_file, run)
     sys.stdout.flush()
-    # Unzip municipality files (if directory does not exist)
-    kommune_dir = os.path.join(dirname, kn)
-    if not os.path.isdir(kommune_dir):
-        #os.mkdir(kommune_dir)
-        zipfile = os.path.join(dirname, kn + "Elveg.zip")
-        os.system('unzip -o -d {0} {1} >/dev/null'.format(kommune_dir, zipfile))
-    # Convert SOSI file to OSM using sosi2osm
-    sosifile = os.path.join(kommune_dir, kn + 'Elveg.SOS')
-    osmfile = os.path.join(kommune_dir, kn + 'Elveg_default.osm')
-    fartfile = os.path.join(kommune_dir, kn + 'Fart.txt')
-    hoydefile = os.path.join(kommune_dir, kn + 'Hoyde.txt')
-    osmoutput = os.path.join(kommune_dir, kn + 'Elveg.osm')
-    logfile = os.path.join(kommune_dir, kn + 'elveg2osm.log')
-    os.system('sosi2osm {0} default.lua >{1}'.format(sosifile, osmfile))
-    os.system('./elveg2osm.py {0} {1} >{2} 2>&1'.format(kommune_dir, kn, logfile))
+
+if pool is not None:
+    pool.close()
+    pool.join()
+
+if args.profile:
+    summary = aggregate_profiles(dirname, kommune_numbers)
+    with open(os.path.join(dirname, profile_summary_name), 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    sys.stdout.write("Slowest municipalities:\n")
+    for kn in summary['slowest'][:10]:
+        sys.stdout.write("  {0}: {1:.1f} s, peak {2:.0f} MB\n".format(
+            kn, summary['municipalities'][kn]['wall'], summary['municipalities'][kn]['peak_rss_mb']))
+    sys.stdout.write("Time per stage:\n")
+    for name,stage in sorted(summary['stages'].iteritems(), key=lambda item: -item[1]['wall']):
+        sys.stdout.write("  {0}: {1:.1f} s (slowest in {2})\n".format(name, stage['wall'], stage['slowest']))
+
+summary = aggregate_diagnostics(dirname, kommune_numbers)
+with open(os.path.join(dirname, diagnostics_summary_name), 'w') as f:
+    json.dump(summary, f, indent=1, sort_keys=True)
+if len(summary['counts']) > 0:
+    sys.stdout.write("Warnings:\n")
+    for code,count in sorted(summary['counts'].iteritems(), key=lambda item: -item[1]):
+        sys.stdout.write("  {0}: {1} (most in {2})\n".format(code, count, summary['worst'][code]))
+
+if args.merge:
+    osmfiles = [output_files(dirname, kn, args.format)[0] for kn in kommune_numbers if kn not in failed]
+    sys.stdout.write("Merging {0} municipalities into {1}\n".format(len(osmfiles), args.merge))
+    sys.stdout.flush()
+    nnodes, nways, nmerged = elveg_merge.merge_osm_files(osmfiles, args.merge, keep_ids=args.id_blocks)
+    sys.stdout.write("Wrote {0} nodes and {1} ways, merged {2} border nodes\n".format(nnodes, nways, nmerged))
+
+if len(failed) > 0:
+    sys.stdout.write("Failed municipalities: {0}\n".format(' '.join(sorted(failed))))
+    sys.exit(1)
@@ -0,0 +1,132 @@
+'''Reading of Elveg input files from directories and zip archives
+
+The national Elveg archive is a zip file with one zip file
+XXXXElveg.zip per municipality, which has the files XXXXElveg.SOS,
+XXXXFart.txt, XXXXHoyde.txt etc. A DirectorySource or ZipSource gives
+the files of a municipality by name, so that they can be read
+without extracting the archives. Nested zip files are read into memory
+(they are compressed, and much smaller than their contents), while
+the members are decompressed while they are read.
+
+'''
+import os
+import io
+import zipfile
+
+class DirectorySource(object):
+    '''Input files in a directory'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        '''Return the full name of a file, e.g. for messages'''
+        return os.path.join(self.directory, name)
+
+    def names(self):
+        return sorted(os.listdir(self.directory))
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def open(self, name):
+        '''Return a binary file object for reading the file'''
+        return open(self.path(name), 'rb')
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def zip_source(self, name):
+        '''Return a ZipSource for a zip file in the directory'''
+        return ZipSource(self.path(name))
+
+    def close(self):
+        pass
+
+class ZipSource(object):
+    '''Input files in a zip archive.
+
+    archive is a file name, or the contents of a zip file read into
+    memory (as a bytearray). The members are found by their base names,
+    as the archives of some municipalities have the files in a
+    subdirectory. label is the name of the archive used by path(), e.g.
+    Elveg.zip/0301Elveg.zip for a nested archive.
+
+    '''
+
+    def __init__(self, archive, label=None):
+        if isinstance(archive, basestring):
+            self.filename = archive
+            self.data = None
+        else:
+            self.filename = None
+            self.data = archive
+        if label is None:
+            label = self.filename or '<zip>'
+        self.label = label
+        self.zipfile = self._open_zipfile()
+        self.members = dict()
+        for info in self.zipfile.infolist():
+            name = os.path.basename(info.filename)
+            if len(name) > 0:
+                self.members[name] = info
+
+    def _open_zipfile(self):
+        if self.data is None:
+            return zipfile.ZipFile(self.filename)
+        return zipfile.ZipFile(io.BytesIO(self.data))
+
+    def path(self, name):
+        return self.label + '/' + name
+
+    def names(self):
+        return sorted(self.members)
+
+    def exists(self, name):
+        return self.members.has_key(name)
+
+    def open(self, name):
+        if not self.members.has_key(name):
+            raise IOError("No file {0} in {1}".format(name, self.label))
+        if self.data is None:
+            # Each member opens the zip file again
+            return self.zipfile.open(self.members[name])
+        # The members of a ZipFile of a file object share the file
+        # position, so each member gets its own ZipFile
+        return self._open_zipfile().open(self.members[name])
+
+    def size(self, name):
+        return self.members[name].file_size
+
+    def zip_source(self, name):
+        '''Return a ZipSource for a zip file in the archive'''
+        with self.open(name) as f:
+            data = bytearray(f.read())
+        return ZipSource(data, self.path(name))
+
+    def close(self):
+        self.zipfile.close()
+
+def open_source(path):
+    '''Return a ZipSource for a zip file name, and a DirectorySource otherwise'''
+    if path.lower().endswith('.zip'):
+        return ZipSource(path)
+    return DirectorySource(path)
+
+def municipality_source(archive_path, kommune_number):
+    '''Return the source with the input files of a municipality.
+
+    archive_path is the national archive (a zip file or the directory
+    it has been extracted to). In a directory, an already extracted
+    subdirectory XXXX with the SOSI file is used if it exists, and
+    otherwise XXXXElveg.zip is read without extracting it.
+
+    '''
+    archive = open_source(archive_path)
+    kommune_dir = os.path.join(archive_path, kommune_number)
+    if (isinstance(archive, DirectorySource)
+        and os.path.isfile(os.path.join(kommune_dir, kommune_number + 'Elveg.SOS'))):
+        return DirectorySource(kommune_dir)
+    source = archive.zip_source(kommune_number + 'Elveg.zip')
+    archive.close()
+    return source
@@ -0,0 +1,130 @@
+#! /usr/bin/env python2
+
+'''elveg_bench [--sizes N,N,...] [--output results.json] [--compare old.json]
+
+Benchmark each stage of elveg2osm.py on synthetic data of several sizes.
+
+For each size (number of ways), input is generated with elveg_synth.py
+and the stages are run in a fresh process with elveg2osm.StageProfiler,
+recording wall time, CPU time, resident memory after the stage and peak
+resident memory. The results are saved as JSON, and can be compared
+with an earlier run to catch regressions.
+
+'''
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+import argparse
+import multiprocessing
+import elveg_synth
+
+kommune_number = '9999'
+
+def run_pipeline(directory):
+    '''Run all stages of elveg2osm.py on the input in directory'''
+    # Warnings are not interesting here
+    sys.stderr = open(os.devnull, 'w')
+    sys.stdout = open(os.devnull, 'w')
+    import elveg2osm
+
+    profiler, changes = elveg2osm.convert_municipality(directory, kommune_number, profile=True)
+    stage_counts = dict((stage['stage'], stage['counts']) for stage in profiler.stages)
+    counts = {'nodes': stage_counts['load']['nodes'],
+              'ways': stage_counts['load']['ways'],
+              'split_ways': stage_counts['convert_ways']['ways']}
+    return profiler.stages, counts
+
+def benchmark(sizes, nodes_per_way, restriction_density, barrier_density, seed, repeat):
+    results = []
+    for ways in sizes:
+        directory = tempfile.mkdtemp(prefix='elveg_bench_')
+        try:
+            elveg_synth.generate(directory, kommune_number, ways, nodes_per_way,
+                                 restriction_density, barrier_density, seed)
+            runs = []
+            for r in range(repeat):
+                # Use a fresh process, so that peak memory is per run
+                pool = multiprocessing.Pool(1)
+                runs.append(pool.apply(run_pipeline, (directory,)))
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(directory)
+        # Keep the fastest run of each stage
+        stages = []
+        for i,stage in enumerate(runs[0][0]):
+            best = min((run[0][i] for run in runs), key=lambda s: s['wall'])
+            stages.append(best)
+        results.append({'ways': ways, 'counts': runs[0][1], 'stages': stages})
+        sys.stdout.write("{0:>8} ways: {1:8.2f} s, peak {2:8.1f} MB\n".format(
+            ways, sum(s['wall'] for s in stages), max(s['peak_rss_mb'] for s in stages)))
+        sys.stdout.flush()
+    return results
+
+def compare(old, new, threshold):
+    '''Print a comparison of two benchmark runs.
+
+    Return the number of stages that are slower (or use more memory)
+    than the threshold fraction.
+
+    '''
+    old_results = dict((r['ways'], r) for r in old['results'])
+    regressions = 0
+    sys.stdout.write("{0:>8} {1:<18} {2:>10} {3:>10} {4:>7} {5:>10}\n".format(
+        'ways', 'stage', 'old wall', 'new wall', 'ratio', 'peak MB'))
+    for result in new['results']:
+        if not old_results.has_key(result['ways']):
+            continue
+        old_stages = dict((s['stage'], s) for s in old_results[result['ways']]['stages'])
+        for stage in result['stages']:
+            if not old_stages.has_key(stage['stage']):
+                continue
+            old_stage = old_stages[stage['stage']]
+            ratio = stage['wall'] / max(old_stage['wall'], 1e-6)
+            memory_ratio = stage['peak_rss_mb'] / max(old_stage['peak_rss_mb'], 1e-6)
+            flag = ''
+            if ratio > 1 + threshold or memory_ratio > 1 + threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            sys.stdout.write("{0:>8} {1:<18} {2:10.3f} {3:10.3f} {4:7.2f} {5:10.1f}{6}\n".format(
+                result['ways'], stage['stage'], old_stage['wall'], stage['wall'],
+                ratio, stage['peak_rss_mb'], flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        help='Comma separated list of numbers of ways')
+    parser.add_argument('--nodes-per-way', type=int, default=10)
+    parser.add_argument('--restriction-density', type=float, default=1.0)
+    parser.add_argument('--barrier-density', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each size this many times and keep the fastest')
+    parser.add_argument('--output', help='Save results as JSON to this file')
+    parser.add_argument('--compare', help='Compare with results saved in this file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Fraction slower than the compared run that counts as a regression')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    results = benchmark(sizes, args.nodes_per_way, args.restriction_density,
+                        args.barrier_density, args.seed, args.repeat)
+    run = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'parameters': vars(args),
+           'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, run, args.threshold) > 0:
+            sys.exit(1)
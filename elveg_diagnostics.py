@@ -0,0 +1,134 @@
+'''Warnings and other diagnostics of the conversion
+
+Each warning has a code (e.g. 'short-distance'), a message, and
+optionally fields with the values the message is about. Warnings are
+counted per code, but only the first limit warnings of each code (and
+then every sample_every-th) are written, so that a municipality with
+many similar problems does not flood the log. The text log and the
+JSONL file (one JSON object per written warning) are buffered.
+
+At the end of the run, summary() gives the counts per code, which is
+also written as the last line of the JSONL file, for elveg_all.py to
+aggregate.
+
+'''
+import sys
+import json
+
+class Diagnostics(object):
+    '''Sink for the warnings of a conversion.
+
+    Messages are written as lines to stream (standard error by
+    default), and as JSON objects to jsonl_file if it is given. With
+    limit None, all warnings are written.
+
+    '''
+
+    def __init__(self, stream=None, jsonl_file=None, limit=100, sample_every=1000,
+                 buffer_size=1000):
+        if stream is None:
+            stream = sys.stderr
+        self.stream = stream
+        self.jsonl_file = jsonl_file
+        self.limit = limit
+        self.sample_every = sample_every
+        self.buffer_size = buffer_size
+        self.counts = dict()
+        self.written = dict()
+        self._lines = []
+        self._records = []
+
+    def warn(self, code, message, **fields):
+        '''Count a warning, and write it unless the code is over the limit'''
+        count = self.counts.get(code, 0) + 1
+        self.counts[code] = count
+        if self.limit is not None and count > self.limit:
+            # Over the limit, only write a sample
+            if self.sample_every <= 0 or (count - self.limit) % self.sample_every != 0:
+                return
+        self.written[code] = self.written.get(code, 0) + 1
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self._lines.append(message)
+        if self.jsonl_file is not None:
+            record = {'code': code, 'message': message}
+            record.update(fields)
+            self._records.append(record)
+        if len(self._lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._lines) > 0:
+            self.stream.write('\n'.join(self._lines) + '\n')
+            self._lines = []
+        if len(self._records) > 0:
+            self.jsonl_file.write(''.join(json.dumps(record, sort_keys=True) + '\n'
+                                          for record in self._records))
+            self._records = []
+
+    def summary(self):
+        '''Return dict with the number of warnings per code, and the
+        number that were not written because of the limit'''
+        return {'counts': dict(self.counts),
+                'suppressed': dict((code, count - self.written.get(code, 0))
+                                   for code,count in self.counts.iteritems()
+                                   if count > self.written.get(code, 0))}
+
+    def close(self):
+        '''Write the summary, flush the buffers and close the JSONL file'''
+        self.flush()
+        summary = self.summary()
+        for code in sorted(summary['counts']):
+            line = "Warnings {0}: {1}".format(code, summary['counts'][code])
+            if summary['suppressed'].has_key(code):
+                line += " ({0} not shown)".format(summary['suppressed'][code])
+            self.stream.write(line + '\n')
+        if self.jsonl_file is not None:
+            record = {'code': 'summary'}
+            record.update(summary)
+            self.jsonl_file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.jsonl_file.close()
+            self.jsonl_file = None
+        return summary
+
+class WarningRecorder(object):
+    '''Keep warnings in a list instead of writing them, e.g. in a worker
+    process. The warnings are (code, message, fields), and are given
+    to a Diagnostics with replay().'''
+
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, code, message, **fields):
+        self.warnings.append((code, message, fields))
+
+def replay(warnings, diagnostics):
+    '''Give recorded warnings to diagnostics'''
+    for code, message, fields in warnings:
+        diagnostics.warn(code, message, **fields)
+
+def read_summary(filename):
+    '''Return the summary from the last line of a JSONL file, or None'''
+    summary = None
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('code') == 'summary':
+                summary = record
+    return summary
+
+def aggregate_summaries(summaries):
+    '''Combine dict of summaries (e.g. per municipality) into total counts per code.
+
+    Return dict with the total count per code, and for each code the
+    key with the most warnings.
+
+    '''
+    totals = dict()
+    worst = dict()
+    for key,summary in summaries.iteritems():
+        for code,count in summary['counts'].iteritems():
+            totals[code] = totals.get(code, 0) + count
+            if not worst.has_key(code) or count > summaries[worst[code]]['counts'][code]:
+                worst[code] = key
+    return {'counts': totals, 'worst': worst}
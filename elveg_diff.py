@@ -0,0 +1,169 @@
+'''Changes between two deliveries of converted Elveg data
+
+Only a small part of the roads change between Elveg deliveries, but the
+ids of the converted elements are not stable (e.g. the split ways and
+nodes are numbered anew). The ways of the previous and the new output
+are therefore matched by their nvdb:id and nvdb:id:part tags, and the
+nodes by their coordinates rounded to 1e-7 degrees (as written). The
+differences are written as an osmChange file, where the matched
+elements keep the ids of the previous output:
+
+- create: new nodes and ways without a match in the previous output
+- modify: matched nodes with other tags, and matched ways with other
+  tags or nodes
+- delete: nodes and ways of the previous output without a match
+
+The created elements keep their new ids, unless the id is used by
+another element of the previous output, in which case they get ids
+below all the ids of both outputs.
+
+'''
+import collections
+import elveg_osmio
+import elveg_merge
+
+class Elements(object):
+    '''The nodes and ways of an OSM file'''
+
+    def __init__(self, filename=None):
+        # (lat, lon, tags) and (nds, tags) by id
+        self.nodes = dict()
+        self.ways = dict()
+        if filename is not None:
+            for element_type, attribs, tags, nds in elveg_osmio.iterparse_osm(filename):
+                if element_type == 'node':
+                    self.nodes[attribs['id']] = (attribs['lat'], attribs['lon'], tags)
+                elif element_type == 'way':
+                    self.ways[attribs['id']] = (nds, tags)
+
+def node_key(node):
+    lat, lon, tags = node
+    return elveg_merge.coordinate_key(lat, lon)
+
+def way_key(way):
+    nds, tags = way
+    return (tags.get('nvdb:id'), tags.get('nvdb:id:part'))
+
+def keyed_ids(elements, key_function):
+    '''Return dict of element ids by (key, n), where n is the number of
+    earlier elements with the same key, e.g. overlapping nodes'''
+    ids = dict()
+    counts = collections.Counter()
+    for eid in sorted(elements):
+        key = key_function(elements[eid])
+        ids[(key, counts[key])] = eid
+        counts[key] += 1
+    return ids
+
+def match_ids(old_elements, new_elements, key_function):
+    '''Return dict of the ids of the old elements by the ids of the
+    matching new elements'''
+    old_ids = keyed_ids(old_elements, key_function)
+    matches = dict()
+    for key, new_id in keyed_ids(new_elements, key_function).iteritems():
+        if old_ids.has_key(key):
+            matches[new_id] = old_ids[key]
+    return matches
+
+def assign_ids(matches, old_elements, new_elements):
+    '''Add the ids of the new elements without a match to matches.
+
+    They keep their ids if no old element has them, and get unused ids
+    below all the old and new ids otherwise.
+
+    '''
+    next_id = min([0] + old_elements.keys() + new_elements.keys()) - 1
+    for new_id in sorted(new_elements, reverse=True):
+        if matches.has_key(new_id):
+            continue
+        if old_elements.has_key(new_id):
+            matches[new_id] = next_id
+            next_id -= 1
+        else:
+            matches[new_id] = new_id
+
+class Change(object):
+    '''The elements to create, modify and delete, as lists of
+    (id, element) with the ids of the change, in the order of the ids
+    of the new (or for deleted elements, the previous) output'''
+
+    def __init__(self):
+        self.create = {'node': [], 'way': []}
+        self.modify = {'node': [], 'way': []}
+        self.delete = {'node': [], 'way': []}
+
+    def counts(self):
+        return dict((action, dict((element_type, len(elements))
+                                  for element_type, elements in getattr(self, action).iteritems()))
+                    for action in ('create', 'modify', 'delete'))
+
+def diff_elements(old, new):
+    '''Return the Change from the Elements old to the Elements new'''
+    change = Change()
+    node_matches = match_ids(old.nodes, new.nodes, node_key)
+    way_matches = match_ids(old.ways, new.ways, way_key)
+    node_ids = dict(node_matches)
+    way_ids = dict(way_matches)
+    assign_ids(node_ids, old.nodes, new.nodes)
+    assign_ids(way_ids, old.ways, new.ways)
+
+    for nid in sorted(new.nodes, reverse=True):
+        node = new.nodes[nid]
+        if not node_matches.has_key(nid):
+            change.create['node'].append((node_ids[nid], node))
+        elif old.nodes[node_ids[nid]][2] != node[2]:
+            change.modify['node'].append((node_ids[nid], node))
+    for wid in sorted(new.ways, reverse=True):
+        nds, tags = new.ways[wid]
+        way = ([node_ids[nid] for nid in nds], tags)
+        if not way_matches.has_key(wid):
+            change.create['way'].append((way_ids[wid], way))
+        elif old.ways[way_ids[wid]] != way:
+            change.modify['way'].append((way_ids[wid], way))
+
+    matched_nodes = set(node_matches.itervalues())
+    matched_ways = set(way_matches.itervalues())
+    for wid in sorted(old.ways, reverse=True):
+        if wid not in matched_ways:
+            change.delete['way'].append((wid, None))
+    for nid in sorted(old.nodes, reverse=True):
+        if nid not in matched_nodes:
+            change.delete['node'].append((nid, None))
+    return change
+
+def write_change(change, output, generator='elveg2osm'):
+    '''Write the Change as osmChange to output, a file name or a file object'''
+    if isinstance(output, basestring):
+        writer = elveg_osmio.OSMChangeWriter(elveg_osmio.open_osm(output, 'wb'), generator, close_file=True)
+    else:
+        writer = elveg_osmio.OSMChangeWriter(output, generator)
+    # Nodes are created before the ways using them, and deleted after
+    # the ways that used them
+    for action in ('create', 'modify'):
+        elements = getattr(change, action)
+        if len(elements['node']) + len(elements['way']) == 0:
+            continue
+        writer.begin(action)
+        for nid, (lat, lon, tags) in elements['node']:
+            writer.write_node(nid, lat, lon, tags)
+        for wid, (nds, tags) in elements['way']:
+            writer.write_way(wid, nds, tags)
+    if len(change.delete['node']) + len(change.delete['way']) > 0:
+        writer.begin('delete')
+        for wid, way in change.delete['way']:
+            writer.write_deleted('way', wid)
+        for nid, node in change.delete['node']:
+            writer.write_deleted('node', nid)
+    writer.close()
+
+def diff_osm_files(old_filename, new_filename, output):
+    '''Write the changes from the OSM file old_filename to new_filename
+    as osmChange to output.
+
+    Return dict with the number of created, modified and deleted nodes
+    and ways, e.g. {'create': {'node': 10, 'way': 2}, ...}.
+
+    '''
+    change = diff_elements(Elements(old_filename), Elements(new_filename))
+    write_change(change, output)
+    return change.counts()
@@ -0,0 +1,126 @@
+'''Merging of converted municipalities into one OSM file
+
+Roads crossing a municipal border end at a node on the border in both
+municipalities. When merging, such duplicated way end nodes are replaced
+by the first node written at the same coordinate, and all elements get
+new negative ids, so that ids from different municipalities do not clash.
+If the municipalities were converted with disjoint id blocks (see
+elveg2osm.IdAllocator), the ids can be kept instead.
+
+The municipalities are streamed one at a time. Only the coordinates of
+way end nodes are kept in memory (in sorted NumPy arrays), and the ways
+are spooled to a temporary file so that all nodes can be written first.
+
+'''
+import marshal
+import tempfile
+import numpy as np
+import elveg_osmio
+
+def coordinate_key(lat, lon):
+    '''Pack a coordinate, rounded to 1e-7 degrees, into one integer'''
+    return (int(round(lat * 1e7)) << 32) | (int(round(lon * 1e7)) + 1800000000)
+
+class EndNodeIndex(object):
+    '''Compact index from coordinate keys to node ids.
+
+    Keys added with add() are only searchable after commit(), so that
+    nodes of one municipality are only merged with nodes of the
+    municipalities written before it.
+
+    '''
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.pending_keys = []
+        self.pending_ids = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.ids[i])
+        return None
+
+    def add(self, key, nid):
+        self.pending_keys.append(key)
+        self.pending_ids.append(nid)
+
+    def commit(self):
+        keys = np.concatenate((self.keys, np.array(self.pending_keys, dtype=np.int64)))
+        ids = np.concatenate((self.ids, np.array(self.pending_ids, dtype=np.int64)))
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.ids = ids[order]
+        self.pending_keys = []
+        self.pending_ids = []
+
+def merge_osm_files(filenames, output, warn=None, keep_ids=False):
+    '''Merge the OSM files into one, written to output.
+
+    output is a file object for OSM XML, or a file name where the
+    format is given by the name (see elveg_osmio.open_writer()).
+
+    Return a tuple (nodes, ways, merged nodes) with the numbers of
+    written nodes and ways, and of duplicated nodes that were merged.
+    With keep_ids, the elements keep their ids, which must be unique
+    across all the files.
+
+    '''
+    if isinstance(output, basestring):
+        writer = elveg_osmio.open_writer(output)
+    else:
+        writer = elveg_osmio.OSMWriter(output)
+    index = EndNodeIndex()
+    spool = tempfile.TemporaryFile()
+    nnodes = 0
+    nways = 0
+    nmerged = 0
+
+    for filename in filenames:
+        # First pass: find the end nodes of the ways
+        end_nodes = set()
+        for element_type, attribs, tags, nds in elveg_osmio.iterparse_osm(filename):
+            if element_type == 'way' and len(nds) > 0:
+                end_nodes.add(nds[0])
+                end_nodes.add(nds[-1])
+
+        # Second pass: write nodes, and spool the ways
+        new_ids = dict()
+        for element_type, attribs, tags, nds in elveg_osmio.iterparse_osm(filename):
+            if element_type == 'node':
+                nid = attribs['id']
+                key = None
+                if nid in end_nodes:
+                    key = coordinate_key(attribs['lat'], attribs['lon'])
+                    existing = index.get(key)
+                    if existing is not None:
+                        if len(tags) == 0:
+                            new_ids[nid] = existing
+                            nmerged += 1
+                            continue
+                        elif warn is not None:
+                            warn(u"Not merging tagged node {0} in {1}".format(nid, filename))
+                nnodes += 1
+                new_ids[nid] = nid if keep_ids else -nnodes
+                writer.write_node(new_ids[nid], attribs['lat'], attribs['lon'], tags)
+                if key is not None:
+                    index.add(key, new_ids[nid])
+            elif element_type == 'way':
+                nways += 1
+                wid = attribs['id'] if keep_ids else -nways
+                marshal.dump((wid, [new_ids[nid] for nid in nds], tags), spool)
+            elif warn is not None:
+                warn(u"Ignoring {0} {1} in {2}".format(element_type, attribs['id'], filename))
+        index.commit()
+
+    spool.seek(0)
+    for i in xrange(nways):
+        wid, nds, tags = marshal.load(spool)
+        writer.write_way(wid, nds, tags)
+    spool.close()
+    writer.close()
+    return nnodes, nways, nmerged
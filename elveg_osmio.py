@@ -0,0 +1,173 @@
+'''Streaming reading and writing of OSM XML files
+
+The functions in this module never keep more than one OSM element in
+memory at a time, in contrast to osmapis.OSM.load() and
+osmapis.OSM.save() which build the whole document.
+
+Files named *.gz or *.bz2 are compressed and decompressed on the fly,
+and files named *.pbf are read and written with elveg_pbf.
+
+'''
+import gzip
+import bz2
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+import elveg_pbf
+
+# Attributes that are converted from strings when reading
+attrib_types = {'id': int,
+                'lat': float,
+                'lon': float,
+                'version': int,
+                'changeset': int,
+                'uid': int}
+
+def open_osm(filename, mode='rb'):
+    '''Open an OSM XML file, which is compressed if the name ends in .gz or .bz2'''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    elif filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, mode)
+    return open(filename, mode)
+
+def iterparse_osm(source):
+    '''Iterate over the elements in an OSM XML (or PBF) file.
+
+    source is a file name or a file object. Yields one tuple
+    (element type, attribs, tags, nds) for each node, way and relation,
+    where nds is the list of node references (empty for nodes).
+
+    '''
+    if isinstance(source, basestring):
+        if source.endswith('.pbf'):
+            for element in elveg_pbf.iterparse_pbf(source):
+                yield element
+            return
+        with open_osm(source) as f:
+            for element in iterparse_osm(f):
+                yield element
+        return
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    root = None
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        # Only process the children of the <osm> root element
+        if depth != 1:
+            continue
+        if elem.tag in ('node', 'way', 'relation'):
+            attribs = dict(elem.attrib)
+            for key, conversion in attrib_types.iteritems():
+                if attribs.has_key(key):
+                    attribs[key] = conversion(attribs[key])
+            tags = {}
+            nds = []
+            for child in elem:
+                if child.tag == 'tag':
+                    tags[child.get('k')] = child.get('v')
+                elif child.tag == 'nd':
+                    nds.append(int(child.get('ref')))
+            yield elem.tag, attribs, tags, nds
+        # Drop the element and everything parsed so far
+        elem.clear()
+        root.clear()
+
+def _quote(value):
+    if isinstance(value, unicode):
+        return quoteattr(value).encode('utf-8')
+    return quoteattr(str(value))
+
+class OSMWriter(object):
+    '''Write OSM XML one element at a time.
+
+    Nodes should be written before ways to get a conventional file.
+    With close_file, the file object is closed by close().
+
+    '''
+
+    def __init__(self, fileobj, generator='elveg2osm', close_file=False):
+        self.fileobj = fileobj
+        self.close_file = close_file
+        self.fileobj.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.fileobj.write("<osm version='0.6' upload='false' generator={0}>\n".format(_quote(generator)))
+
+    def _write_tags(self, tags):
+        write = self.fileobj.write
+        for key in sorted(tags):
+            write('    <tag k={0} v={1}/>\n'.format(_quote(key), _quote(tags[key])))
+
+    def write_node(self, nid, lat, lon, tags):
+        if len(tags) == 0:
+            self.fileobj.write('  <node id="{0}" lat="{1:.7f}" lon="{2:.7f}"/>\n'.format(nid, lat, lon))
+        else:
+            self.fileobj.write('  <node id="{0}" lat="{1:.7f}" lon="{2:.7f}">\n'.format(nid, lat, lon))
+            self._write_tags(tags)
+            self.fileobj.write('  </node>\n')
+
+    def write_way(self, wid, nds, tags):
+        write = self.fileobj.write
+        write('  <way id="{0}">\n'.format(wid))
+        for nid in nds:
+            write('    <nd ref="{0}"/>\n'.format(nid))
+        self._write_tags(tags)
+        write('  </way>\n')
+
+    def close(self):
+        self.fileobj.write('</osm>\n')
+        if self.close_file:
+            self.fileobj.close()
+
+class OSMChangeWriter(OSMWriter):
+    '''Write an osmChange file one element at a time.
+
+    The elements are written in sections started with begin('create'),
+    begin('modify') or begin('delete'). Deleted elements are only
+    written with their ids, by write_deleted().
+
+    '''
+
+    def __init__(self, fileobj, generator='elveg2osm', close_file=False):
+        self.fileobj = fileobj
+        self.close_file = close_file
+        self.action = None
+        self.fileobj.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.fileobj.write("<osmChange version='0.6' generator={0}>\n".format(_quote(generator)))
+
+    def begin(self, action):
+        self.end()
+        self.fileobj.write('<{0}>\n'.format(action))
+        self.action = action
+
+    def end(self):
+        '''End the current section'''
+        if self.action is not None:
+            self.fileobj.write('</{0}>\n'.format(self.action))
+            self.action = None
+
+    def write_deleted(self, element_type, eid):
+        self.fileobj.write('  <{0} id="{1}"/>\n'.format(element_type, eid))
+
+    def close(self):
+        self.end()
+        self.fileobj.write('</osmChange>\n')
+        if self.close_file:
+            self.fileobj.close()
+
+# Output formats, by file name extension
+output_formats = ['osm', 'osm.gz', 'osm.bz2', 'osm.pbf']
+
+def open_writer(filename, generator='elveg2osm'):
+    '''Return a writer for filename, in the format given by the extension.
+
+    The writer has the methods write_node(), write_way() and close(),
+    which also closes the file.
+
+    '''
+    if filename.endswith('.pbf'):
+        return elveg_pbf.PBFWriter(open(filename, 'wb'), generator, close_file=True)
+    return OSMWriter(open_osm(filename, 'wb'), generator, close_file=True)
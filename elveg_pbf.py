@@ -0,0 +1,329 @@
+'''Writing and reading of OSM PBF files
+
+Only what is needed for the output of elveg2osm is supported: nodes
+are written as dense nodes, ways with their tags and node references,
+and no metadata (versions, timestamps, users). Each block of up to
+block_size elements has its own string table, and is compressed with
+zlib. The protocol buffer messages are encoded by hand, following
+https://wiki.openstreetmap.org/wiki/PBF_Format
+
+'''
+import struct
+import zlib
+
+# Coordinates are stored in units of granularity nanodegrees
+granularity = 100
+
+# Protocol buffer wire types
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+def _varint(value, out):
+    '''Append value (>= 0) as a varint to the bytearray out'''
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+def _int64(value, out):
+    # Negative int64 values are encoded as 64 bit two's complement
+    if value < 0:
+        value += 1 << 64
+    _varint(value, out)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _key(field, wire_type, out):
+    _varint((field << 3) | wire_type, out)
+
+def _bytes_field(field, data, out):
+    _key(field, _LENGTH_DELIMITED, out)
+    _varint(len(data), out)
+    out.extend(data)
+
+def _varint_field(field, value, out):
+    _key(field, _VARINT, out)
+    _int64(value, out)
+
+def _packed_field(field, values, out, encode=_varint):
+    packed = bytearray()
+    for value in values:
+        encode(value, packed)
+    _bytes_field(field, packed, out)
+
+def _packed_delta_field(field, values, out):
+    '''Packed sint64 field of the differences between the values'''
+    packed = bytearray()
+    last = 0
+    for value in values:
+        _varint(_zigzag(value - last), packed)
+        last = value
+    _bytes_field(field, packed, out)
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class PBFWriter(object):
+    '''Write OSM PBF one element at a time, with the same interface as
+    elveg_osmio.OSMWriter.
+
+    Nodes should be written before ways, which is required by most
+    programs reading PBF.
+
+    '''
+
+    def __init__(self, fileobj, generator='elveg2osm', close_file=False, block_size=8000):
+        self.fileobj = fileobj
+        self.close_file = close_file
+        self.block_size = block_size
+        self.nodes = []
+        self.ways = []
+        header = bytearray()
+        _bytes_field(4, 'OsmSchema-V0.6', header)
+        _bytes_field(4, 'DenseNodes', header)
+        _bytes_field(16, _encode(generator), header)
+        self._write_blob('OSMHeader', header)
+
+    def _write_blob(self, blob_type, data):
+        blob = bytearray()
+        _varint_field(2, len(data), blob)
+        _bytes_field(3, zlib.compress(str(data)), blob)
+        blob_header = bytearray()
+        _bytes_field(1, blob_type, blob_header)
+        _varint_field(3, len(blob), blob_header)
+        self.fileobj.write(struct.pack('>I', len(blob_header)))
+        self.fileobj.write(str(blob_header))
+        self.fileobj.write(str(blob))
+
+    def _write_block(self, group):
+        '''Write a primitive block with a single primitive group'''
+        block = bytearray()
+        _bytes_field(1, self._string_table, block)
+        _bytes_field(2, group, block)
+        self._write_blob('OSMData', block)
+
+    def _init_strings(self):
+        # String 0 is not used, as 0 separates the tags of dense nodes
+        self._strings = {}
+        self._string_table = bytearray()
+        _bytes_field(1, '', self._string_table)
+
+    def _string(self, value):
+        value = _encode(value)
+        index = self._strings.get(value)
+        if index is None:
+            index = self._strings[value] = len(self._strings) + 1
+            _bytes_field(1, value, self._string_table)
+        return index
+
+    def _flush_nodes(self):
+        if len(self.nodes) == 0:
+            return
+        self._init_strings()
+        keys_vals = []
+        for nid, lat, lon, tags in self.nodes:
+            for key in sorted(tags):
+                keys_vals.append(self._string(key))
+                keys_vals.append(self._string(tags[key]))
+            keys_vals.append(0)
+        dense = bytearray()
+        _packed_delta_field(1, [node[0] for node in self.nodes], dense)
+        _packed_delta_field(8, [int(round(node[1] * 1e9 / granularity)) for node in self.nodes], dense)
+        _packed_delta_field(9, [int(round(node[2] * 1e9 / granularity)) for node in self.nodes], dense)
+        _packed_field(10, keys_vals, dense)
+        group = bytearray()
+        _bytes_field(2, dense, group)
+        self._write_block(group)
+        self.nodes = []
+
+    def _flush_ways(self):
+        if len(self.ways) == 0:
+            return
+        self._init_strings()
+        group = bytearray()
+        for wid, nds, tags in self.ways:
+            keys = sorted(tags)
+            way = bytearray()
+            _varint_field(1, wid, way)
+            _packed_field(2, [self._string(key) for key in keys], way)
+            _packed_field(3, [self._string(tags[key]) for key in keys], way)
+            _packed_delta_field(8, nds, way)
+            _bytes_field(3, way, group)
+        self._write_block(group)
+        self.ways = []
+
+    def write_node(self, nid, lat, lon, tags):
+        self._flush_ways()
+        self.nodes.append((nid, lat, lon, tags))
+        if len(self.nodes) >= self.block_size:
+            self._flush_nodes()
+
+    def write_way(self, wid, nds, tags):
+        self._flush_nodes()
+        self.ways.append((wid, list(nds), tags))
+        if len(self.ways) >= self.block_size:
+            self._flush_ways()
+
+    def close(self):
+        self._flush_nodes()
+        self._flush_ways()
+        if self.close_file:
+            self.fileobj.close()
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _fields(data):
+    '''Iterate over (field, value) of a message, where the value is an
+    int for varints and a string for length delimited fields'''
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protocol buffer wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+def _unpack(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def _unpack_delta(data):
+    values = []
+    last = 0
+    for value in _unpack(data):
+        last += _unzigzag(value)
+        values.append(last)
+    return values
+
+def _signed(value):
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+def _read_blob(data):
+    for field, value in _fields(data):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+    raise ValueError("Unsupported PBF blob compression")
+
+def _parse_block(data):
+    strings = []
+    groups = []
+    block_granularity = granularity
+    lat_offset = 0
+    lon_offset = 0
+    for field, value in _fields(data):
+        if field == 1:
+            strings = [s.decode('utf-8') for f, s in _fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block_granularity = value
+        elif field == 19:
+            lat_offset = _signed(value)
+        elif field == 20:
+            lon_offset = _signed(value)
+
+    def coordinate(value, offset):
+        return 1e-9 * (offset + block_granularity * value)
+
+    for group in groups:
+        for field, value in _fields(group):
+            if field == 2:
+                ids = lats = lons = keys_vals = ()
+                for dense_field, dense_value in _fields(value):
+                    if dense_field == 1:
+                        ids = _unpack_delta(dense_value)
+                    elif dense_field == 8:
+                        lats = _unpack_delta(dense_value)
+                    elif dense_field == 9:
+                        lons = _unpack_delta(dense_value)
+                    elif dense_field == 10:
+                        keys_vals = _unpack(dense_value)
+                kv = 0
+                for nid, lat, lon in zip(ids, lats, lons):
+                    tags = {}
+                    while kv < len(keys_vals) and keys_vals[kv] != 0:
+                        tags[strings[keys_vals[kv]]] = strings[keys_vals[kv + 1]]
+                        kv += 2
+                    kv += 1
+                    attribs = {'id': nid,
+                               'lat': coordinate(lat, lat_offset),
+                               'lon': coordinate(lon, lon_offset)}
+                    yield 'node', attribs, tags, []
+            elif field == 3:
+                wid = None
+                keys = vals = nds = ()
+                for way_field, way_value in _fields(value):
+                    if way_field == 1:
+                        wid = _signed(way_value)
+                    elif way_field == 2:
+                        keys = _unpack(way_value)
+                    elif way_field == 3:
+                        vals = _unpack(way_value)
+                    elif way_field == 8:
+                        nds = _unpack_delta(way_value)
+                tags = dict((strings[k], strings[v]) for k, v in zip(keys, vals))
+                yield 'way', {'id': wid}, tags, list(nds)
+            elif field == 1:
+                raise ValueError("Non-dense nodes are not supported")
+
+def iterparse_pbf(source):
+    '''Iterate over the nodes and ways in an OSM PBF file.
+
+    source is a file name or a file object. Yields the same tuples
+    (element type, attribs, tags, nds) as elveg_osmio.iterparse_osm().
+
+    '''
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            for element in iterparse_pbf(f):
+                yield element
+        return
+    while True:
+        length = source.read(4)
+        if len(length) < 4:
+            break
+        blob_type = None
+        for field, value in _fields(source.read(struct.unpack('>I', length)[0])):
+            if field == 1:
+                blob_type = value
+            elif field == 3:
+                datasize = value
+        data = _read_blob(source.read(datasize))
+        if blob_type == 'OSMData':
+            for element in _parse_block(data):
+                yield element
@@ -0,0 +1,187 @@
+'''Reading of the Elveg restriction tables (XXXXFart.txt, XXXXHoyde.txt)
+
+The tables are semicolon separated files with a few header lines,
+followed by a line with column names and one row per restriction.
+The column names are padded with whitespace, and the padding differs
+between the files, so the columns are found by their stripped names.
+
+Only interval tables are supported, i.e. with a value for the part of
+a TRANSID from Fra to Til. The turn restrictions of XXXXSving.txt
+refer to pairs of TRANSIDs and are not read.
+
+'''
+import csv
+import collections
+import numpy as np
+
+# Columns found in all restriction tables
+transid_column = 'TransID'
+start_column = 'Fra'
+stop_column = 'Til'
+
+# The restrictions of a single TRANSID, sorted on start.
+# rows is the row number in the file, for resolving overlaps
+# in the same way as the file order.
+Restrictions = collections.namedtuple('Restrictions', ['starts', 'stops', 'values', 'rows'])
+
+class RestrictionTable(object):
+    '''Restrictions read from one table, stored in columns per TRANSID'''
+
+    def __init__(self, transids=(), starts=(), stops=(), values=()):
+        transids = np.array(transids, dtype=object)
+        starts = np.array(starts, dtype=int)
+        stops = np.array(stops, dtype=int)
+        values = np.array(values, dtype=object)
+        rows = np.arange(len(transids))
+
+        # Sort on TRANSID, then on start (the sort is stable, so rows
+        # with the same start keep the file order)
+        unique_transids, codes = np.unique(transids, return_inverse=True)
+        order = np.lexsort((starts, codes))
+        self.starts = starts[order]
+        self.stops = stops[order]
+        self.values = values[order]
+        self.rows = rows[order]
+
+        # Slice of the columns for each TRANSID
+        codes = codes[order]
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1, [len(codes)]))
+        self.slices = dict()
+        for i in range(len(boundaries) - 1):
+            lo, hi = boundaries[i], boundaries[i + 1]
+            if hi > lo:
+                self.slices[unique_transids[codes[lo]]] = (lo, hi)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, transid):
+        return transid in self.slices
+
+    def transids(self):
+        return self.slices.keys()
+
+    def get(self, transid):
+        '''Return the Restrictions for transid, or None'''
+        if not self.slices.has_key(transid):
+            return None
+        lo, hi = self.slices[transid]
+        return Restrictions(self.starts[lo:hi], self.stops[lo:hi],
+                            self.values[lo:hi], self.rows[lo:hi])
+
+def _find_column(header, name):
+    '''Return index of column name, ignoring whitespace and case'''
+    stripped = [h.strip().lower() for h in header]
+    try:
+        return stripped.index(name.strip().lower())
+    except ValueError:
+        raise KeyError("Column {0!r} not found in header {1!r}".format(name, header))
+
+def read_restriction_table(source, value_column, header_lines=4):
+    '''Read an interval restriction table (TransID;Fra;Til;value) from
+    a file name or file object.
+
+    value_column is the name of the column with the restriction value,
+    e.g. 'Fart' for XXXXFart.txt and 'H\\xf8yde' for XXXXHoyde.txt.
+    The first header_lines lines are skipped before the column names.
+
+    '''
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            return read_restriction_table(f, value_column, header_lines)
+
+    for i in range(header_lines):
+        source.next()
+    reader = csv.reader(source, delimiter=';')
+    header = reader.next()
+    transid_index = _find_column(header, transid_column)
+    start_index = _find_column(header, start_column)
+    stop_index = _find_column(header, stop_column)
+    value_index = _find_column(header, value_column)
+
+    rows = [row for row in reader if len(row) > 0]
+    transids = [row[transid_index].strip() for row in rows]
+    starts = [int(row[start_index]) for row in rows]
+    stops = [int(row[stop_index]) for row in rows]
+    values = [row[value_index].strip() for row in rows]
+    return RestrictionTable(transids, starts, stops, values)
+
+# Registered restriction types, in the order they are read
+RestrictionType = collections.namedtuple('RestrictionType',
+                                         ['tag', 'filename_suffix', 'value_column', 'required'])
+restriction_types = []
+
+def register_restriction_type(tag, filename_suffix, value_column, required=False):
+    '''Register a restriction table to be read and tagged on the ways.
+
+    tag is the OSM key for the values, and the table is read from
+    the file XXXX + filename_suffix. A missing file is an error if
+    the table is required. For instance, axle loads could be added with
+    register_restriction_type('maxaxleload', 'Aksel.txt', 'Aksel')
+
+    '''
+    restriction_types.append(RestrictionType(tag, filename_suffix, value_column, required))
+
+register_restriction_type('maxspeed', 'Fart.txt', 'Fart', required=True)
+register_restriction_type('maxheight', 'Hoyde.txt', 'H\xf8yde')
+
+# Result of segment_restrictions(). segment_tags has one dict of
+# tags per segment, and outside_points are the end points that were
+# outside the length of the way.
+Segmentation = collections.namedtuple('Segmentation', ['split_points', 'segment_tags', 'outside_points'])
+
+def segment_restrictions(length, restrictions):
+    '''Find the segments of a way where the restrictions are constant.
+
+    length is the length of the way (from VPA) and restrictions is a
+    dict with tags as keys and Restrictions (or None) as values.
+    A segment gets the value of a restriction if the restriction covers
+    the whole segment. If several restrictions of the same type cover a
+    segment, the last one in the file wins.
+
+    The restriction boundaries are visited in a single sorted sweep,
+    keeping track of the restrictions that are active.
+
+    '''
+    # Events (position, kind, tag, row, value), where kind 0 is the start
+    # and kind 1 is the stop of a restriction, so that starts are
+    # processed before stops at the same position. Kind 2 is an end
+    # point of an empty restriction.
+    events = []
+    for tag,restr in restrictions.iteritems():
+        if restr is None:
+            continue
+        for start, stop, value, row in zip(restr.starts, restr.stops, restr.values, restr.rows):
+            if stop > start:
+                events.append((start, 0, tag, row, value))
+                events.append((stop, 1, tag, row, value))
+            else:
+                # Covers no segment, but still an end point
+                events.append((start, 2, tag, row, value))
+                events.append((stop, 2, tag, row, value))
+    events.sort()
+
+    # All positions where a restriction may change, within the way
+    end_points = sorted(set([0, length] + [int(e[0]) for e in events]))
+    outside_points = [p for p in end_points if p < 0 or p > length]
+    end_points = [p for p in end_points if 0 <= p <= length]
+
+    active = dict((tag, dict()) for tag in restrictions)
+    segment_tags = []
+    i = 0
+    for position in end_points[:-1]:
+        # Apply all events up to and including this position
+        while i < len(events) and events[i][0] <= position:
+            _, kind, tag, row, value = events[i]
+            if kind == 0:
+                active[tag][row] = value
+            elif kind == 1:
+                active[tag].pop(row, None)
+            i += 1
+        tags = dict()
+        for tag,rows in active.iteritems():
+            if len(rows) > 0:
+                tags[tag] = rows[max(rows)]
+        segment_tags.append(tags)
+
+    return Segmentation(end_points[1:-1], segment_tags, outside_points[::-1])
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+'''Reading of Elveg SOSI files (XXXXElveg.SOS) without sosi2osm
+
+Only the subset of SOSI used by Elveg is supported: .KURVE and .PUNKT
+objects with their attributes and ..NØ or ..NØH coordinates. The
+coordinates are given in UTM (or geographic coordinates) with the
+coordinate system, unit and origin from the ..TRANSPAR block of .HODE,
+and are converted to WGS84 latitudes and longitudes.
+
+Attributes are returned with the raw value as the tag value, like
+sosi2osm does, i.e. '..VPA 1: 0 499;' gives the tag VPA='1: 0 499;'.
+Attributes with sub-attributes (e.g. ..VNR with ...VEGKATEGORI) are
+flattened, so each sub-attribute becomes a tag of its own.
+
+'''
+import re
+import itertools
+import collections
+import numpy as np
+
+# SOSI coordinate systems (KOORDSYS) that are UTM, and their zones
+# (EUREF89 / WGS84)
+utm_zones = {21: 31, 22: 32, 23: 33, 24: 34, 25: 35, 26: 36}
+# Geographic coordinates in EUREF89
+geographic_koordsys = 84
+
+# Python codecs for the SOSI character sets (TEGNSETT)
+charsets = {'ISO8859-1': 'latin-1',
+            'ISO8859-10': 'iso8859_10',
+            'ANSI': 'cp1252',
+            'UTF-8': 'utf-8',
+            'DOSN8': 'cp865',
+            'ND7': 'ascii',
+            'DECN7': 'ascii'}
+# The 7-bit character sets use these ASCII characters for the Norwegian letters
+_nd7_letters = dict((ord(c), l) for c,l in zip(u'[\\]{|}', u'\xc6\xd8\xc5\xe6\xf8\xe5'))
+# Elveg is delivered in ISO8859-10, so use that if TEGNSETT is missing
+default_charset = 'ISO8859-10'
+
+_charset_pattern = re.compile(r'^\s*\.\.TEGNSETT\s+(\S+)')
+_coordinate_keywords = (u'N\xd8', u'N\xd8H')
+
+# WGS84 ellipsoid and UTM parameters
+_a = 6378137.
+_f = 1 / 298.257223563
+_k0 = 0.9996
+_false_easting = 500000.
+
+# Coefficients of the Krüger series for the inverse transverse Mercator
+# projection, to fourth order in the third flattening n
+_n = _f / (2 - _f)
+_A = _a / (1 + _n) * (1 + _n**2 / 4 + _n**4 / 64)
+_beta = [_n / 2 - 2 * _n**2 / 3 + 37 * _n**3 / 96 - _n**4 / 360,
+         _n**2 / 48 + _n**3 / 15 - 437 * _n**4 / 1440,
+         17 * _n**3 / 480 - 37 * _n**4 / 840,
+         4397 * _n**4 / 161280]
+_delta = [2 * _n - 2 * _n**2 / 3 - 2 * _n**3 + 116 * _n**4 / 45,
+          7 * _n**2 / 3 - 8 * _n**3 / 5 - 227 * _n**4 / 45,
+          56 * _n**3 / 15 - 136 * _n**4 / 35,
+          4279 * _n**4 / 630]
+
+def utm_to_latlon(northings, eastings, zone):
+    '''Convert arrays of UTM coordinates (northern hemisphere) in a zone
+    to arrays of WGS84 latitudes and longitudes in degrees'''
+    xi = np.asarray(northings, dtype=float) / (_k0 * _A)
+    eta = (np.asarray(eastings, dtype=float) - _false_easting) / (_k0 * _A)
+    xi_prime = xi.copy()
+    eta_prime = eta.copy()
+    for j,beta in enumerate(_beta):
+        k = 2 * (j + 1)
+        xi_prime -= beta * np.sin(k * xi) * np.cosh(k * eta)
+        eta_prime -= beta * np.cos(k * xi) * np.sinh(k * eta)
+    # Conformal latitude
+    chi = np.arcsin(np.sin(xi_prime) / np.cosh(eta_prime))
+    lat = chi.copy()
+    for j,delta in enumerate(_delta):
+        lat += delta * np.sin(2 * (j + 1) * chi)
+    lon0 = np.radians(6 * zone - 183)
+    lon = lon0 + np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+    return np.degrees(lat), np.degrees(lon)
+
+# A SOSI object, with group 'KURVE', 'PUNKT' etc., the serial number,
+# the attributes as a dict and arrays of latitudes and longitudes
+SosiObject = collections.namedtuple('SosiObject', ['group', 'serial', 'tags', 'lats', 'lons'])
+
+class SosiReader(object):
+    '''Iterate over the objects of a SOSI file.
+
+    The header (.HODE) is read when the first object is requested,
+    and sets the attributes charset, koordsys, unit and origin.
+    The coordinates are converted in batches of about batch_size
+    points, so that the conversion is vectorized.
+
+    '''
+
+    def __init__(self, source, batch_size=1 << 16):
+        if isinstance(source, basestring):
+            source = open(source, 'rb')
+        self.source = source
+        self.batch_size = batch_size
+        self.charset = None
+        self.koordsys = None
+        self.unit = 1.
+        self.origin = (0., 0.)
+
+    def _lines(self):
+        '''Iterate over (level, keyword, value) of the lines.
+
+        Coordinate lines have level 0, no keyword and the whole line
+        as the value.
+
+        '''
+        lines = iter(self.source)
+        # Buffer the header lines until the character set is known
+        header = []
+        for line in lines:
+            header.append(line)
+            match = _charset_pattern.match(line)
+            if match is not None:
+                decode = self._set_charset(match.group(1))
+                break
+            if line.startswith('.') and not line.startswith('..') and not line.startswith('.HODE'):
+                # The first object, and still no TEGNSETT
+                break
+        if self.charset is None:
+            decode = self._set_charset(default_charset)
+
+        for line in itertools.chain(header, lines):
+            line = decode(line)
+            # Remove comments, unless they may be inside a quoted value
+            if u'!' in line and u'"' not in line:
+                line = line[:line.index(u'!')]
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if not line.startswith(u'.'):
+                yield 0, None, line
+                continue
+            level = len(line) - len(line.lstrip(u'.'))
+            parts = line[level:].split(None, 1)
+            keyword = parts[0]
+            value = parts[1].strip() if len(parts) > 1 else u''
+            yield level, keyword, value
+
+    def _set_charset(self, name):
+        name = name.upper()
+        if not charsets.has_key(name):
+            raise ValueError("Unsupported SOSI character set {0}".format(name))
+        self.charset = name
+        codec = charsets[name]
+        if codec == 'ascii':
+            return lambda line: line.decode('ascii', 'replace').translate(_nd7_letters)
+        return lambda line: line.decode(codec, 'replace')
+
+    def _parse_header(self, keyword, value):
+        if keyword == u'KOORDSYS':
+            self.koordsys = int(value.split()[0])
+        elif keyword == u'ENHET':
+            self.unit = float(value.split()[0])
+        elif keyword == u'ORIGO-N\xd8':
+            northing, easting = value.split()[:2]
+            self.origin = (float(northing), float(easting))
+
+    def _convert(self, batch):
+        '''Convert the coordinates of a batch of objects to SosiObjects'''
+        npoints = sum(len(coords) for _, _, _, coords in batch)
+        raw = np.zeros((npoints, 2))
+        start = 0
+        for _, _, _, coords in batch:
+            raw[start:start + len(coords)] = coords
+            start += len(coords)
+        northings = self.origin[0] + raw[:,0] * self.unit
+        eastings = self.origin[1] + raw[:,1] * self.unit
+        if self.koordsys == geographic_koordsys:
+            lats, lons = northings, eastings
+        elif utm_zones.has_key(self.koordsys):
+            lats, lons = utm_to_latlon(northings, eastings, utm_zones[self.koordsys])
+        else:
+            raise ValueError("Unsupported SOSI coordinate system KOORDSYS {0}".format(self.koordsys))
+        start = 0
+        for group, serial, tags, coords in batch:
+            stop = start + len(coords)
+            yield SosiObject(group, serial, tags, lats[start:stop], lons[start:stop])
+            start = stop
+
+    def __iter__(self):
+        batch = []
+        npoints = 0
+        # The current object as (group, serial, tags, coordinates)
+        current = None
+        # Number of values per point, when reading coordinates
+        point_size = None
+        for level, keyword, value in self._lines():
+            if level == 1:
+                if current is not None and current[0] != u'HODE':
+                    batch.append(current)
+                    npoints += len(current[3])
+                    if npoints >= self.batch_size:
+                        for obj in self._convert(batch):
+                            yield obj
+                        batch = []
+                        npoints = 0
+                point_size = None
+                if keyword == u'SLUTT':
+                    current = None
+                    break
+                current = (keyword, value.rstrip(u':').strip(), dict(), [])
+                continue
+            if current is None:
+                continue
+            if level == 0 or keyword in _coordinate_keywords:
+                if level > 0:
+                    point_size = 3 if keyword == u'N\xd8H' else 2
+                elif point_size is None:
+                    continue
+                # Coordinates, possibly followed by point attributes (...KP)
+                numbers = value.split(u'...')[0].split()
+                for i in range(0, len(numbers) - 1, point_size):
+                    current[3].append((float(numbers[i]), float(numbers[i + 1])))
+                continue
+            if point_size is not None and level > 2:
+                # Attribute of the previous point, e.g. ...KP
+                continue
+            point_size = None
+            if current[0] == u'HODE':
+                self._parse_header(keyword, value)
+            elif len(value) > 0:
+                if len(value) > 1 and value[0] == value[-1] and value[0] in u'"\'':
+                    value = value[1:-1]
+                current[2][keyword] = value
+        if current is not None and current[0] != u'HODE':
+            batch.append(current)
+        if len(batch) > 0:
+            for obj in self._convert(batch):
+                yield obj
@@ -0,0 +1,191 @@
+#! /usr/bin/env python2
+
+'''elveg_synth [options] directory XXXX
+
+Generate synthetic Elveg input for a municipality XXXX, i.e. the files
+XXXXElveg_default.osm (as written by sosi2osm), XXXXFart.txt and
+XXXXHoyde.txt, for benchmarking the conversion.
+
+The roads form a grid, where each way runs between two junction nodes
+that are shared with the neighbouring ways.
+
+'''
+
+import os
+import math
+import random
+import argparse
+import elveg_osmio
+
+# Approximate meters per degree, for placing nodes and computing VPA
+meters_per_degree_lat = 111132.
+meters_per_degree_lon = 111320.
+
+objtypes = [u'VegSenterlinje'] * 16 + [u'Svingekonnekteringslenke',
+                                       u'GangSykkelVegSenterlinje',
+                                       u'Fortau',
+                                       u'Bilferjestrekning']
+road_categories = 'EFRKKKKPPS'
+road_statuses = 'VVVVVVVVTWAGMPQ'
+ferry_statuses = 'SSSSE'
+lane_values = ['1#2'] * 8 + ['1', '2', '1#3', '2#4', '1#3#5', '', '1#2#3K']
+medium_values = ['L', 'U', 'B']
+street_names = [u'Storgata', u'Kirkeveien', u'Kj\xf8rbuveien', u'Ringveg', u'Fjordgata']
+barrier_types = [u'Betongkjegle', u'Bilsperre', u'Bussluse', u'L\xe5st bom',
+                 u'New Jersey', u'R\xf8rgelender', u'Steinblokk',
+                 u'Trafikkavviser', u'Ukjent']
+speed_limits = ['30', '40', '50', '60', '70', '80', '90', '100']
+height_limits = ['2.8', '3.5', '4.0', '4.2', '4.5']
+
+def _way_tags(rng, transid, length):
+    objtype = rng.choice(objtypes)
+    tags = {'TRANSID': str(transid),
+            'OBJTYPE': objtype,
+            'DATAFANGSTDATO': '2012%02d%02d' % (rng.randint(1, 12), rng.randint(1, 28)),
+            'VPA': '1: 0 %d;' % length}
+    if objtype == u'Bilferjestrekning':
+        tags['VNR'] = '%s %s %d:' % (rng.choice('ERF'), rng.choice(ferry_statuses), rng.randint(1, 999))
+    elif objtype != u'Fortau':
+        tags['VNR'] = '%s %s %d:' % (rng.choice(road_categories), rng.choice(road_statuses), rng.randint(1, 999))
+    if rng.random() < 0.4:
+        tags['GATENAVN'] = rng.choice(street_names)
+    if objtype != u'Fortau' and rng.random() < 0.5:
+        tags['VKJORFLT'] = rng.choice(lane_values)
+    if rng.random() < 0.05:
+        tags['MEDIUM'] = rng.choice(medium_values)
+    return tags
+
+def _restrictions(rng, length, density):
+    '''Return list of (start, stop) covering [0, length], with about
+    density extra split points'''
+    nsplits = min(int(rng.expovariate(1. / density)) if density > 0 else 0, length - 1)
+    points = sorted(rng.sample(xrange(1, length), nsplits)) if nsplits > 0 else []
+    ends = [0] + points + [length]
+    return zip(ends[:-1], ends[1:])
+
+def generate(directory, kommune_number, ways=1000, nodes_per_way=10,
+             restriction_density=1.0, barrier_density=0.05, seed=0,
+             lat0=60.0, lon0=10.0):
+    '''Write synthetic Elveg input files to directory.
+
+    ways is the number of ways, nodes_per_way the average number of
+    nodes per way (including the junctions), restriction_density the
+    average number of speed limit changes per way, and barrier_density
+    the number of barriers per way.
+
+    '''
+    rng = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Grid of junctions, with horizontal and vertical ways between them
+    grid_size = int(math.ceil(math.sqrt(ways / 2.))) + 1
+    spacing = 100. * nodes_per_way
+    dlat = spacing / meters_per_degree_lat
+    dlon = spacing / (meters_per_degree_lon * math.cos(math.radians(lat0)))
+
+    node_id = [0]
+    node_coords = []
+    node_tags = {}
+    def new_node(lat, lon):
+        node_id[0] -= 1
+        node_coords.append((node_id[0], lat, lon))
+        return node_id[0]
+
+    junctions = {}
+    def junction(i, j):
+        if not junctions.has_key((i, j)):
+            junctions[(i, j)] = new_node(lat0 + i * dlat, lon0 + j * dlon)
+        return junctions[(i, j)]
+
+    way_list = []
+    transid = 100000
+    for k in xrange(ways):
+        cell = k // 2
+        i, j = cell // grid_size, cell % grid_size
+        if k % 2 == 0:
+            start, end = (i, j), (i, j + 1)
+        else:
+            start, end = (i, j), (i + 1, j)
+        lat_a, lon_a = lat0 + start[0] * dlat, lon0 + start[1] * dlon
+        lat_b, lon_b = lat0 + end[0] * dlat, lon0 + end[1] * dlon
+        nds = [junction(*start)]
+        ninner = max(0, int(rng.gauss(nodes_per_way - 2, (nodes_per_way - 2) / 3.)))
+        for n in range(ninner):
+            t = (n + 1.) / (ninner + 1)
+            # Small wiggle perpendicular to the way
+            wiggle = rng.uniform(-0.05, 0.05)
+            lat = lat_a + t * (lat_b - lat_a) + wiggle * (lon_b - lon_a) * dlat / dlon
+            lon = lon_a + t * (lon_b - lon_a) + wiggle * (lat_b - lat_a) * dlon / dlat
+            nds.append(new_node(lat, lon))
+        nds.append(junction(*end))
+        transid += 1
+        # VPA length, with some disagreement with the geometry
+        length = max(2, int(spacing * rng.uniform(0.97, 1.03)))
+        way_list.append((-(k + 1), nds, _way_tags(rng, transid, length)))
+
+    # Barriers, mostly on top of a way node, but some detached. The way
+    # nodes are chosen with replacement, so some get two barriers, which
+    # the conversion must handle when their types conflict.
+    way_node_coords = node_coords[:]
+    nbarriers = int(round(barrier_density * ways))
+    for b in xrange(nbarriers):
+        _, lat, lon = rng.choice(way_node_coords)
+        if rng.random() < 0.1:
+            lat += rng.uniform(1, 5) / meters_per_degree_lat
+        nid = new_node(lat, lon)
+        node_tags[nid] = {'OBJTYPE': 'Vegsperring',
+                          'VEGSPERRINGTYPE': rng.choice(barrier_types)}
+    # A few other free-standing points
+    for b in xrange(max(1, ways // 500)):
+        for objtype in ['Kommunedele', 'Ferjekai']:
+            _, lat, lon = rng.choice(way_node_coords)
+            nid = new_node(lat + 10 / meters_per_degree_lat, lon)
+            node_tags[nid] = {'OBJTYPE': objtype}
+
+    with open(os.path.join(directory, kommune_number + 'Elveg_default.osm'), 'wb') as f:
+        writer = elveg_osmio.OSMWriter(f, generator='elveg_synth')
+        for nid, lat, lon in node_coords:
+            writer.write_node(nid, lat, lon, node_tags.get(nid, {}))
+        for wid, nds, tags in way_list:
+            writer.write_way(wid, nds, tags)
+        writer.close()
+
+    with open(os.path.join(directory, kommune_number + 'Fart.txt'), 'wb') as f:
+        f.write('Fartsgrenser for kommune {0}\r\nEksportert fra syntetiske data\r\n{1}\r\n\r\n'.format(kommune_number, ways))
+        f.write('Fra; TransID;   Til; Fart\r\n')
+        for wid, nds, tags in way_list:
+            if rng.random() < 0.9:
+                length = int(tags['VPA'].split()[2].strip(';'))
+                for start, stop in _restrictions(rng, length, restriction_density):
+                    f.write('%4d;%s;%6d;%s\r\n' % (start, tags['TRANSID'], stop, rng.choice(speed_limits)))
+
+    with open(os.path.join(directory, kommune_number + 'Hoyde.txt'), 'wb') as f:
+        f.write('H\xf8ydebegrensninger for kommune {0}\r\nEksportert fra syntetiske data\r\n\r\n\r\n'.format(kommune_number))
+        f.write('Fra; TransID;   Til;H\xf8yde\r\n')
+        for wid, nds, tags in way_list:
+            if rng.random() < 0.1 * restriction_density:
+                length = int(tags['VPA'].split()[2].strip(';'))
+                start = rng.randint(0, length - 1)
+                stop = min(length, start + rng.randint(1, 50))
+                f.write('%4d;%s;%6d;%s\r\n' % (start, tags['TRANSID'], stop, rng.choice(height_limits)))
+
+    return len(node_coords), len(way_list)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('directory')
+    parser.add_argument('kommune_number')
+    parser.add_argument('--ways', type=int, default=1000)
+    parser.add_argument('--nodes-per-way', type=int, default=10)
+    parser.add_argument('--restriction-density', type=float, default=1.0,
+                        help='Average number of speed limit changes per way')
+    parser.add_argument('--barrier-density', type=float, default=0.05,
+                        help='Number of barriers per way')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    nnodes, nways = generate(args.directory, args.kommune_number, args.ways,
+                             args.nodes_per_way, args.restriction_density,
+                             args.barrier_density, args.seed)
+    print "Wrote {0} nodes and {1} ways to {2}".format(nnodes, nways, args.directory)
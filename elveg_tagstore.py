@@ -0,0 +1,129 @@
+'''Compact storage of the tags of ways and nodes
+
+Most of the ways of a municipality have tags with the same keys and
+many of the same values (e.g. OBJTYPE=VegSenterlinje or
+source=Kartverket Elveg). A StringTable keeps one copy of each distinct
+key and value, for the Elveg tags as they are loaded and the OSM tags
+as they are created.
+
+The OSM tags of a way are mostly given by a few of its Elveg tags (see
+elveg2osm.TagMapping), so CowTags keep them as a base dict, which is
+shared by all ways with the same base tags and never changed, and
+only the tags of the way itself (e.g. nvdb:id and name) in a dict of
+their own. The segments of a split way share that dict too, until a
+tag of one of them is changed (copy-on-write).
+
+'''
+import collections
+
+class StringTable(object):
+    '''Table of interned keys and values.
+
+    Unlike intern(), works for unicode as well as str. The table is
+    kept by the object using it (e.g. an ElvegOSM), so the strings are
+    freed with it. The values of the keys in unique_keys (e.g. TRANSID)
+    are not interned, as they are different for each element.
+
+    '''
+
+    def __init__(self, unique_keys=()):
+        self.strings = dict()
+        self.unique_keys = frozenset(unique_keys)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        '''Return the copy of string in the table'''
+        return self.strings.setdefault(string, string)
+
+    def intern_tags(self, tags):
+        '''Return dict of tags with interned keys and values'''
+        strings = self.strings
+        unique_keys = self.unique_keys
+        return dict((strings.setdefault(key, key),
+                     value if key in unique_keys else strings.setdefault(value, value))
+                    for key,value in tags.iteritems())
+
+class CowTags(collections.MutableMapping):
+    '''Tags as a shared base dict and a dict of their own.
+
+    The base dict must not be changed once it is used by CowTags. Tags
+    are set in the dict of their own, where a removed base tag has the
+    value None. copy() gives tags that share both dicts, and the dict
+    of their own is copied the first time either of them is changed.
+
+    '''
+    __slots__ = ('base', '_own', '_shared')
+
+    def __init__(self, base, own=None):
+        self.base = base
+        if own is not None and len(own) == 0:
+            own = None
+        self._own = own
+        self._shared = False
+
+    def copy(self):
+        '''Return copy of the tags, sharing the dicts until either is changed'''
+        tags = CowTags(self.base, self._own)
+        if self._own is not None:
+            self._shared = tags._shared = True
+        return tags
+
+    def _writable(self):
+        if self._own is None:
+            self._own = dict()
+        elif self._shared:
+            self._own = dict(self._own)
+            self._shared = False
+        return self._own
+
+    def __getitem__(self, key):
+        if self._own is not None and key in self._own:
+            value = self._own[key]
+        else:
+            value = self.base.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        own = self._writable()
+        if key in self.base:
+            own[key] = None
+        else:
+            del own[key]
+
+    def __contains__(self, key):
+        if self._own is not None and key in self._own:
+            return self._own[key] is not None
+        return key in self.base
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        own = self._own
+        if own is None:
+            for key in self.base:
+                yield key
+            return
+        for key in self.base:
+            if key not in own:
+                yield key
+        for key,value in own.iteritems():
+            if value is not None:
+                yield key
+
+    def __len__(self):
+        if self._own is None:
+            return len(self.base)
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return 'CowTags({0!r})'.format(dict(self.iteritems()))
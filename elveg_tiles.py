@@ -0,0 +1,59 @@
+'''Spatial tiles for converting parts of a municipality in parallel
+
+The ways (or barriers) of a municipality are divided into strips by
+longitude, with about the same number of elements in each, and the
+work for each strip is done by a pool of worker processes. The work
+must only depend on its task, and the results are returned in the
+order of the tasks, so that the results are the same whatever the
+number of tiles.
+
+'''
+import multiprocessing
+import numpy as np
+
+def strip_tiles(lons, ntiles):
+    '''Divide elements into at most ntiles strips by longitude.
+
+    Return an array with the tile number of each element, and a list
+    of the (west, east) longitudes of the elements of each tile.
+
+    '''
+    lons = np.asarray(lons, dtype=float)
+    ntiles = max(1, min(ntiles, len(lons)))
+    # Stable sort, so that elements at the same longitude keep their order
+    order = np.argsort(lons, kind='mergesort')
+    tile_of = np.zeros(len(lons), dtype=int)
+    bounds = []
+    for tile, members in enumerate(np.array_split(order, ntiles)):
+        tile_of[members] = tile
+        if len(members) > 0:
+            bounds.append((lons[members[0]], lons[members[-1]]))
+        else:
+            bounds.append((np.inf, -np.inf))
+    return tile_of, bounds
+
+def tile_members(tile_of, ntiles):
+    '''Return a list with the indexes of the elements of each tile, in
+    the original order of the elements'''
+    members = [[] for tile in range(ntiles)]
+    for i, tile in enumerate(tile_of):
+        members[tile].append(i)
+    return members
+
+def map_tiles(function, tasks, processes):
+    '''Return [function(task) for task in tasks], computed by up to
+    processes worker processes.
+
+    The workers of a multiprocessing.Pool (e.g. of elveg_all.py
+    --jobs) can not start processes of their own, so the tasks are
+    then done one at a time in this process.
+
+    '''
+    if processes <= 1 or len(tasks) <= 1 or multiprocessing.current_process().daemon:
+        return [function(task) for task in tasks]
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        return pool.map(function, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,36 @@
+'''Tests of elveg2osm.py, run with python -m unittest test_elveg2osm'''
+import unittest
+import StringIO
+import elveg2osm
+import elveg_diagnostics
+
+class MergeBarriersTest(unittest.TestCase):
+
+    def test_conflicting_barriers_at_same_way_node(self):
+        diagnostics = elveg_diagnostics.Diagnostics(stream=StringIO.StringIO())
+        osmobj = elveg2osm.ElvegOSM(diagnostics=diagnostics)
+        osmobj.nodes.add(-1, 59.9, 10.7)
+        osmobj.nodes.add(-2, 59.9, 10.701)
+        osmobj._add_way({'id': -1}, [-1, -2], {'OBJTYPE': u'VegSenterlinje', 'TRANSID': u'1'})
+        # Two barriers of different types, 2 and 3 cm from way node -1
+        offset = 0.01 / elveg2osm.CoordinateIndex.meters_per_degree_lat
+        osmobj.nodes.add(-3, 59.9 + 2 * offset, 10.7, {},
+                         {'OBJTYPE': u'Vegsperring', 'VEGSPERRINGTYPE': u'Betongkjegle'})
+        osmobj.nodes.add(-4, 59.9 - 3 * offset, 10.7, {},
+                         {'OBJTYPE': u'Vegsperring', 'VEGSPERRINGTYPE': u'Bussluse'})
+
+        coord_index = elveg2osm.CoordinateIndex(osmobj, elveg2osm.barrier_merge_tolerance)
+        osmobj_barriers = elveg2osm.merge_barriers(osmobj, coord_index)
+
+        # One barrier is merged into the way node, the other is detached
+        self.assertEqual(len(osmobj_barriers.nodes), 1)
+        detached_id = osmobj_barriers.nodes.keys()[0]
+        merged_id = ({-3, -4} - {detached_id}).pop()
+        self.assertNotIn(detached_id, osmobj.nodes)
+        self.assertNotIn(merged_id, osmobj.nodes)
+        merged_barrier = {-3: 'block', -4: 'bus_trap'}[merged_id]
+        self.assertEqual(dict(osmobj.nodes[-1].tags), {'barrier': merged_barrier})
+        self.assertEqual(diagnostics.counts, {'barrier-conflict': 1})
+
+if __name__ == '__main__':
+    unittest.main()